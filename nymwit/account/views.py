@@ -67,10 +67,10 @@ def profile(request, username):
     profile = get_document_or_404(User, username=username)
 
     current = Game.objects(players=profile.username, state__in=('playing', 'voting'))
-    current.order_by('next_ending')
+    current.order_by('next_ending').only(*Game.summary_fields)
 
     past = Game.objects(players=profile.username, state__in=('invalid', 'finished')).limit(10)
-    past.order_by('-next_ending')
+    past.order_by('-next_ending').only(*Game.summary_fields)
 
     prefs_form = None
     # if profile == request.user:
@@ -0,0 +1,212 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# game events let heartbeats wait for something to happen to a
+# game, rather than repeatedly asking the database. whenever a game
+# changes, publish() an event for it; a heartbeat subscribe()s to
+# the game and wait()s on the subscription.
+#
+# the backend is chosen by settings.GAME_EVENTS_BACKEND:
+#
+# * game.events.LocalEventBus delivers events only within the
+#   process which published them; fine for a single web process
+#
+# * game.events.MongoEventBus delivers events to every process,
+#   through a capped collection in the game database which each
+#   process tails
+
+__all__ = ('publish', 'publish_many', 'subscribe', 'LocalEventBus', 'MongoEventBus')
+
+from logging import getLogger
+import threading
+import time
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from pymongo.errors import CollectionInvalid
+
+log = getLogger('game.events')
+
+class Subscription(object):
+
+    def __init__(self, bus, game_id):
+        self.bus = bus
+        self.game_id = game_id
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        # block until an event for the game is published, or
+        # timeout seconds pass. returns True if any events
+        # were published since the subscription was made or
+        # wait was last called, False otherwise
+        self.event.wait(timeout)
+        pending = self.event.is_set()
+        self.event.clear()
+        return pending
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+class LocalEventBus(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def publish(self, game_id, kind):
+        self.publish_many([game_id], kind)
+
+    def publish_many(self, game_ids, kind):
+        for game_id in game_ids:
+            self.deliver(str(game_id), kind)
+
+    def deliver(self, game_id, kind):
+        # wakes only the game's own subscriptions
+        self.lock.acquire()
+        try:
+            subscriptions = list(self.subscriptions.get(game_id, ()))
+        finally:
+            self.lock.release()
+        for subscription in subscriptions:
+            subscription.event.set()
+
+    def subscribe(self, game_id):
+        subscription = Subscription(self, str(game_id))
+        self.lock.acquire()
+        try:
+            self.subscriptions.setdefault(subscription.game_id, []).append(subscription)
+        finally:
+            self.lock.release()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.lock.acquire()
+        try:
+            subscriptions = self.subscriptions.get(subscription.game_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.game_id, None)
+        finally:
+            self.lock.release()
+
+class MongoEventBus(LocalEventBus):
+
+    collection_name = 'game_events'
+    collection_size = 1024 * 1024
+
+    def __init__(self):
+        super(MongoEventBus, self).__init__()
+        self.collection = None
+        self.tailer = None
+
+    def get_collection(self):
+        if self.collection is None:
+            from game.models import Game
+            db = Game.objects._collection.database
+            try:
+                db.create_collection(self.collection_name, capped=True,
+                                     size=self.collection_size)
+                # a tailable cursor on an empty capped
+                # collection is immediately dead, so give
+                # it something to start from
+                db[self.collection_name].insert({'g': None, 'k': 'start'})
+            except CollectionInvalid:
+                # already exists
+                pass
+            self.collection = db[self.collection_name]
+        return self.collection
+
+    def publish_many(self, game_ids, kind):
+        # delivered to this process, too, by the tailer
+        events = [{'g': str(game_id), 'k': kind} for game_id in game_ids]
+        if events:
+            self.get_collection().insert(events)
+
+    def subscribe(self, game_id):
+        self.lock.acquire()
+        try:
+            if self.tailer is None:
+                self.tailer = threading.Thread(target=self.tail)
+                self.tailer.daemon = True
+                self.tailer.start()
+        finally:
+            self.lock.release()
+        return super(MongoEventBus, self).subscribe(game_id)
+
+    def tail(self):
+        last = None
+        while True:
+            try:
+                collection = self.get_collection()
+                if last is None:
+                    newest = list(collection.find().sort('$natural', -1).limit(1))
+                    if not newest:
+                        # created by another process, which
+                        # hasn't inserted its start event yet
+                        collection.insert({'g': None, 'k': 'start'})
+                        continue
+                    last = newest[0]['_id']
+                # events are read in insertion ($natural) order,
+                # which isn't _id order, since each process makes
+                # its own ids. so the cursor starts at the oldest
+                # event, and those up to and including last are
+                # skipped. if last has been overwritten since, it
+                # is never seen, and skipping stops once the
+                # cursor has caught up instead
+                cursor = collection.find(tailable=True, await_data=True)
+                skipping = True
+                while cursor.alive:
+                    for event in cursor:
+                        if skipping:
+                            skipping = event['_id'] != last
+                            continue
+                        last = event['_id']
+                        if event['g'] is not None:
+                            self.deliver(event['g'], event['k'])
+                    skipping = False
+            except Exception:
+                log.exception('error tailing %s', self.collection_name)
+            # the cursor dies if the collection wraps around
+            # faster than we read it, or on errors
+            time.sleep(1)
+
+_bus = None
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        module, _, name = settings.GAME_EVENTS_BACKEND.rpartition('.')
+        _bus = getattr(import_module(module), name)()
+    return _bus
+
+def publish(game_id, kind):
+    get_bus().publish(game_id, kind)
+
+def publish_many(game_ids, kind):
+    get_bus().publish_many(game_ids, kind)
+
+def subscribe(game_id):
+    return get_bus().subscribe(game_id)
@@ -0,0 +1,85 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# rendered lists of a user's games (see the cachegamelist template
+# tag) are cached in django's cache, under keys which include a
+# generation number for the user whose games they list. anything
+# which changes a user's games calls invalidate() for them, which
+# moves them on to a new generation, so their old fragments are
+# never read again, and expire from the cache in time.
+#
+# each fragment is stored with the earliest next_ending of the
+# active games it lists, and is not used past then, since by
+# then at least one of those games has changed state. with more
+# than one web process, configure a cache shared between them
+# (see CACHES in settings.py), so that each sees the others'
+# invalidations.
+
+__all__ = ('get', 'store', 'invalidate')
+
+from datetime import datetime
+from hashlib import md5
+from pytz import utc
+
+from django.conf import settings
+from django.core.cache import cache
+
+from util import generation, next_generation
+
+def _userkey(username):
+    # usernames may have characters memcached doesn't
+    # allow in keys
+    return md5(username.encode('utf-8')).hexdigest()
+
+def _generation_key(username):
+    return 'gamelist-generation:%s' % _userkey(username)
+
+def _key(owner, name, viewer):
+    current = generation(cache, _generation_key(owner),
+                         settings.GAMELIST_GENERATION_TIMEOUT)
+    return 'gamelist:%s:%s:%d:%s' % (name, _userkey(owner), current,
+                                     _userkey(viewer))
+
+def get(owner, name, viewer):
+    # the cached html of owner's list of games called name,
+    # as rendered for viewer, or None
+    cached = cache.get(_key(owner, name, viewer))
+    if cached is None:
+        return None
+    html, expires = cached
+    if expires is not None and expires <= datetime.now(utc):
+        return None
+    return html
+
+def store(owner, name, viewer, html, expires):
+    # cache html, the rendering of owner's list of games
+    # called name for viewer, until expires (a datetime),
+    # or GAMELIST_CACHE_TIMEOUT seconds pass
+    cache.set(_key(owner, name, viewer), (html, expires),
+              settings.GAMELIST_CACHE_TIMEOUT)
+
+def invalidate(usernames):
+    for username in usernames:
+        next_generation(cache, _generation_key(username))
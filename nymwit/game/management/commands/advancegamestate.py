@@ -23,38 +23,148 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import sys
 from pytz import utc
 from logging import getLogger
+from multiprocessing import Pool
+from optparse import make_option
+import os
+import socket
 
 from datetime import datetime, timedelta
 from django.core.management.base import NoArgsCommand
 
 from game.models import Game
+from game.models import Leaderboard
 
 log = getLogger('job.advancegamestate')
 
+def advance_leased(args):
+    # advance games in a worker process, claiming each game
+    # with a lease first so that no other worker (in this
+    # process pool, or on another host) advances it too. a
+    # lease left behind by a worker which crashed expires
+    # after lease_seconds, and the game can be claimed again.
+    # returns a dict of (from_state, to_state) to the number
+    # of games moved
+    batch_size, lease_seconds = args
+    owner = '%s:%d' % (socket.gethostname(), os.getpid())
+    games = Game.objects._collection
+    moved = {}
+
+    while True:
+        now = datetime.now(utc)
+        claimed = []
+        for i in range(batch_size):
+            game = games.find_and_modify(
+                query={'state': {'$in': ['playing', 'voting']},
+                       'next_ending': {'$lte': now},
+                       'lease_expires': {'$not': {'$gt': now}}},
+                update={'$set': {'lease_owner': owner,
+                                 'lease_expires': now + timedelta(seconds=lease_seconds)}},
+                sort={'next_ending': 1},
+                new=True)
+            if game is None:
+                break
+            claimed.append(Game._from_son(game))
+
+        if not claimed:
+            return moved
+
+        for game in claimed:
+            from_state = game.state
+            to_state = game.advance(now)
+            if to_state is not None:
+                moved[from_state, to_state] = moved.get((from_state, to_state), 0) + 1
+            games.update({'_id': game.pk, 'lease_owner': owner},
+                         {'$unset': {'lease_owner': 1, 'lease_expires': 1}})
+
 class Command(NoArgsCommand):
     args = ''
     help = 'Advances game state from "playing" to "voting" to "finished" as necessary for active games'
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=0,
+            help='Advance games in this many worker processes, each claiming '
+                 'games with a lease, rather than in bulk'),
+        make_option('--batch', type='int', default=20,
+            help='Number of games each worker claims at a time'),
+        make_option('--lease', type='int', default=60,
+            help='Seconds before a game claimed by a worker may be claimed '
+                 'by another'),
+    )
+
+    def transition(self, now, from_state, to_state, query, update=None, rename=None):
+        # move every game in from_state whose round has ended
+        # and which matches query to to_state, setting the
+        # fields in update and renaming those in rename as
+        # well, in one multi-document update. returns the
+        # number of games moved
+        games = Game.objects._collection
+        query = dict(query, state=from_state, next_ending={'$lte': now})
+        game_ids = [g['_id'] for g in games.find(query, {'_id': 1})]
+        if not game_ids:
+            return 0
+
+        query['_id'] = {'$in': game_ids}
+        update = dict(update or {}, state=to_state)
+        if from_state == 'playing':
+            update['open_slots'] = 0
+        update = {'$set': update, '$inc': {'version': 1}}
+        if rename:
+            update['$rename'] = rename
+        result = games.update(query, update, multi=True, safe=True)
+        moved = result['n']
+
+        Game.transitioned(game_ids, from_state, to_state, moved)
+        log.debug('advanced %d games from %s to %s', moved, from_state, to_state)
+        return moved
+
+    def handle_leased(self, workers, batch_size, lease_seconds):
+        # no database access may happen in this process before
+        # the pool is created, so that workers don't share
+        # the parent's connection
+        pool = Pool(workers)
+        results = pool.map(advance_leased, [(batch_size, lease_seconds)] * workers)
+        pool.close()
+        pool.join()
+
+        moved = {}
+        for result in results:
+            for edge, count in result.items():
+                moved[edge] = moved.get(edge, 0) + count
+        return moved
+
     def handle_noargs(self, **options):
-        games = Game.objects(state__in=('playing', 'voting'), next_ending__lte=datetime.now(utc))
-        for game in games:
-            if game.state == 'playing':
-                if game.num_players < 2:
-                    game.update(set__state='invalid')
-                    log.debug('advanced game %s from playing to invalid, only %d players', game.pk, game.num_players)
-                else:
-                    new_next_ending = game.next_ending + timedelta(minutes=game.minutes_per_round)
-                    game.update(set__state='voting', set__next_ending=new_next_ending)
-                    log.debug('advanced game %s from playing to voting, next ending %s', game.pk, new_next_ending)
-            elif game.state == 'voting':
-                total_votes = sum(len(play.upvotes) for play in game.plays)
-                if total_votes == 0:
-                    game.update(set__state='invalid')
-                    log.debug('advanced game %s from voting to invalid, 0 votes', game.pk)
-                else:
-                    game.update(set__state='finished')
-                log.debug('advanced game %s from voting to finished', game.pk)
+        if options['workers'] > 0:
+            moved = self.handle_leased(options['workers'], options['batch'], options['lease'])
+        else:
+            moved = self.handle_bulk()
+
+        for (from_state, to_state), count in sorted(moved.items()):
+            log.info('%s -> %s: %d games', from_state, to_state, count)
+
+        scored = Leaderboard.score_unscored()
+        if scored:
+            log.info('scored %d games left unscored', scored)
+
+    def handle_bulk(self):
+        now = datetime.now(utc)
+        moved = {}
+
+        moved['playing', 'invalid'] = self.transition(
+            now, 'playing', 'invalid', {'num_players': {'$lt': 2}})
+
+        # the voting round ends when the game's voting_ends
+        # says, just as Game.advance would have it; a game
+        # whose voting round has already ended moves on again
+        # below
+        moved['playing', 'voting'] = self.transition(
+            now, 'playing', 'voting',
+            {'num_players': {'$gte': 2}, 'voting_ends': {'$exists': True}},
+            rename={'voting_ends': 'next_ending'})
 
+        moved['voting', 'invalid'] = self.transition(
+            now, 'voting', 'invalid', {'total_votes': 0})
+        moved['voting', 'finished'] = self.transition(
+            now, 'voting', 'finished', {'total_votes': {'$gt': 0}})
+        return moved
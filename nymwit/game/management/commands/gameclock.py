@@ -0,0 +1,138 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import heapq
+from logging import getLogger
+from pytz import utc
+import time
+
+from datetime import datetime, timedelta
+from django.core.management.base import NoArgsCommand
+
+from game.models import Game
+from game.models import Leaderboard
+
+log = getLogger('jobs.gameclock')
+
+def seconds(delta):
+    return 86400 * delta.days + delta.seconds + delta.microseconds / 1e6
+
+class Command(NoArgsCommand):
+    args = ''
+    help = 'Runs continuously, advancing the state of each game as its rounds end'
+
+    # games are loaded into the schedule when their rounds
+    # are due to end within this long. it must be shorter
+    # than the shortest round (see game.forms), so that a
+    # game's next round always ends beyond what has been
+    # loaded already, and is picked up by a later refresh
+    window = timedelta(minutes=5)
+
+    # how often to look for newly-due games, and to report
+    # scheduling lag
+    refresh_every = timedelta(seconds=30)
+
+    fields = ('state', 'next_ending', 'minutes_per_round', 'num_players', 'total_votes')
+
+    def __init__(self):
+        super(Command, self).__init__()
+        self.schedule = []
+        self.scheduled = set()
+        self.loaded_until = None
+        self.lags = []
+
+    def add(self, game_id, next_ending):
+        if (game_id, next_ending) not in self.scheduled:
+            self.scheduled.add((game_id, next_ending))
+            heapq.heappush(self.schedule, (next_ending, game_id))
+
+    def refresh(self, now):
+        # load games whose rounds end between what has been
+        # loaded already and the end of the window, as well
+        # as any which are overdue (e.g. were missed while
+        # this command wasn't running)
+        until = now + self.window
+        games = Game.objects(state__in=('playing', 'voting'), next_ending__lte=until)
+        if self.loaded_until is not None:
+            overdue = Game.objects(state__in=('playing', 'voting'), next_ending__lte=now)
+            for game in overdue.only('next_ending'):
+                self.add(game.pk, game.next_ending)
+            games = games.filter(next_ending__gt=self.loaded_until)
+        for game in games.only('next_ending'):
+            self.add(game.pk, game.next_ending)
+        self.loaded_until = until
+
+    def advance_due(self, now):
+        while self.schedule and self.schedule[0][0] <= now:
+            next_ending, game_id = heapq.heappop(self.schedule)
+            self.scheduled.discard((game_id, next_ending))
+
+            game = Game.objects(pk=game_id).only(*self.fields).first()
+            if game is None or game.next_ending != next_ending:
+                # the game was advanced by someone else
+                continue
+
+            new_state = game.advance(now)
+            if new_state is None:
+                continue
+
+            lag = seconds(datetime.now(utc) - next_ending)
+            self.lags.append(lag)
+            log.debug('advanced game %s to %s, %.2fs late', game_id, new_state, lag)
+            if new_state == 'voting':
+                self.add(game.pk, game.next_ending)
+
+    def report(self):
+        if self.lags:
+            log.info('advanced %d games, lag mean %.2fs max %.2fs',
+                     len(self.lags), sum(self.lags) / len(self.lags), max(self.lags))
+        self.lags = []
+
+    def score_unscored(self):
+        # games whose scoring failed as they finished
+        try:
+            scored = Leaderboard.score_unscored()
+        except Exception:
+            log.exception('error scoring unscored games')
+            return
+        if scored:
+            log.info('scored %d games left unscored', scored)
+
+    def handle_noargs(self, **options):
+        next_refresh = datetime.now(utc)
+        while True:
+            now = datetime.now(utc)
+            if now >= next_refresh:
+                self.report()
+                self.refresh(now)
+                self.score_unscored()
+                next_refresh = now + self.refresh_every
+
+            self.advance_due(now)
+
+            wake = next_refresh
+            if self.schedule:
+                wake = min(wake, self.schedule[0][0])
+            time.sleep(max(0, seconds(wake - datetime.now(utc))))
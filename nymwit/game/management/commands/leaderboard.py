@@ -23,7 +23,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from logging import getLogger
 from pytz import utc
 import sys
@@ -32,9 +32,7 @@ import time
 from django.core.management.base import NoArgsCommand
 from mongoengine import Document
 from mongoengine import fields
-from bson.code import Code
 from pymongo.errors import OperationFailure
-from pymongo import ASCENDING, DESCENDING
 
 from game.models import Game
 from game.models import Leaderboard
@@ -43,82 +41,16 @@ log = getLogger('jobs.leaderboard')
 
 class Command(NoArgsCommand):
     args = ''
-    help = 'Updates the leaderboard based on games finished since the last run'
-
-    map_func = Code("""
-        function() {
-            var next_ending = this.next_ending;
-
-            var year = next_ending.getFullYear();
-            var month = next_ending.getMonth() + 1;
-            month = month < 10 ? "0" + month : "" + month;
-
-            // weeknum is the whole number of weeks since
-            // Jan 4, 1970 at midnight, a Sunday; 277200000
-            // is milliseconds since midnight Jan 1 1970
-            var weeknum = Math.floor(((next_ending - 277200000) / 86400000) / 7);
-
-            var plays = this.plays;
-            for (var i=0; i<plays.length; i++) {
-                var play = plays[i];
-                var score = play.upvotes.length;
-                var doc = {};
-                doc["a"] = score;
-                doc["y" + year] = score;
-                doc["m" + year + month] = score;
-                doc["w" + weeknum] = score;
-                emit(play.username, doc);
-            }
-        }
-        """)
-
-    reduce_func = Code("""
-        function(key, values) {
-            var out = {};
-            for (var i=0; i<values.length; i++) {
-                var doc = values[i];
-                for (var k in doc) {
-                    if (!doc.hasOwnProperty(k))
-                        continue;
-                    out[k] = (out[k] || 0) + doc[k];
-                }
-            }
-            return out;
-        }
-        """)
-
-    def ensure_indices(self, leaderboard, date):
-        year_key = date.strftime('value.y%Y')
-        month_key = date.strftime('value.m%Y%m')
-        week_key = 'value.w%s' % Leaderboard.weeknum(date)
-
-        log.info('ensuring indices: %s %s %s', year_key, month_key, week_key)
-
-        leaderboard.ensure_index([
-            (year_key, DESCENDING),
-            ('_id', ASCENDING)
-        ], sparse=True)
-        leaderboard.ensure_index([
-            (month_key, DESCENDING),
-            ('_id', ASCENDING)
-        ], sparse=True)
-        leaderboard.ensure_index([
-            (week_key, DESCENDING),
-            ('_id', ASCENDING)
-        ], sparse=True)
-        leaderboard.ensure_index([
-            ('a', DESCENDING),
-            ('_id', ASCENDING)
-        ])
-
+    help = ('Adds finished games which were not scored as they finished '
+            'to the leaderboard (see also rebuildleaderboard)')
 
     def handle_noargs(self, **options):
         now = datetime.now(utc)
 
-        leaderboard = Leaderboard.objects._collection
-        bookkeeping = leaderboard.bookkeeping
+        games = Game.objects._collection
+        bookkeeping = games.database['leaderboard.bookkeeping']
 
-        # acquire the "lock" to prevent (potential) other m-r
+        # acquire the "lock" to prevent (potential) other
         # jobs on leaderboard from running concurrently
         try:
             lock = bookkeeping.find_and_modify(
@@ -136,45 +68,25 @@ class Command(NoArgsCommand):
             sys.exit(1)
 
         try:
-            # find the last updated date in the leaderboard,
-            # or the earliest finished game if no leaderboard
-            # entries exist yet
-            start = lock.get('last_update')
-            if not start:
-                log.debug('running first time')
-                first_game = Game.objects(state='finished')
-                first_game = first_game.order_by('next_ending').first()
-
-                if first_game:
-                    start = first_game.next_ending
-                else:
-                    start = datetime.now(utc)
-
-            end = datetime.now(utc)
-
-            if end > start:
-                log.info('map-reduce %s to %s', start, end)
-                Game.objects._collection.map_reduce(
-                    map=self.map_func,
-                    reduce=self.reduce_func,
-                    out=leaderboard.name,
-                    reduce_output=True,
-                    query=Game.objects(
-                        state='finished',
-                        next_ending__gte=start,
-                        next_ending__lt=end)._query
-                )
-
-                # iterate each week between start and
-                # end, and ensure indices exist on all
-                # the score fields that they should
-                for d in range(0, (end - start).days + 6, 7):
-                    self.ensure_indices(leaderboard, start + timedelta(days=d))
-            else:
-                log.info('nothing to map-reduce')
+            if lock.get('last_update'):
+                # earlier runs of this job counted the games which
+                # finished before last_update, but didn't mark them
+                # as scored
+                games.update({'state': 'finished',
+                              'scored_at': {'$exists': False},
+                              'next_ending': {'$lt': lock['last_update']}},
+                             {'$set': {'scored_at': lock['last_update']}},
+                             multi=True, safe=True)
+                bookkeeping.update({'_id': 1}, {'$unset': {'last_update': 1}})
+
+            # games whose scoring was interrupted are picked
+            # up again, and only their missing scores added
+            game_ids = Leaderboard.unscored()
+            log.info('scoring %d unscored games', len(game_ids))
+            Leaderboard.score(game_ids)
 
         except:
-            log.exception('error during leaderboard map-reduce')
+            log.exception('error scoring games')
 
         finally:
             finish = datetime.now(utc)
@@ -183,5 +95,4 @@ class Command(NoArgsCommand):
             log.info('finished, took %ss', diff)
             bookkeeping.find_and_modify(
                 query={'_id': 1},
-                update={'$set': {'locked': False, 'last_update': end}})
-
+                update={'$set': {'locked': False}})
@@ -0,0 +1,176 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from datetime import timedelta
+from hashlib import md5
+from logging import getLogger
+import random
+
+from bson.objectid import ObjectId
+from django.core.management.base import NoArgsCommand
+from pymongo.errors import DuplicateKeyError
+
+from game.models import Chat
+from game.models import ChatBucket
+from game.models import Counter
+from game.models import Game
+from game.models import vote_key
+
+log = getLogger('jobs.migrategames')
+
+class Command(NoArgsCommand):
+    args = ''
+    help = 'Migrates Game documents stored in older layouts to the current one'
+
+    def migrate_chat(self, games):
+        # move chat embedded in the Game into ChatBuckets.
+        # the buckets are written first, and the chat only
+        # removed from the Game once they all have been. each
+        # bucket's id is made from the game's and the offset
+        # of its first message, so that a bucket written by
+        # an earlier (interrupted) or concurrent run of this
+        # command is not written again
+        buckets = ChatBucket.objects._collection
+        migrated = 0
+        for game in games.find({'chat': {'$exists': True}}, {'chat': 1}):
+            chat = [Chat._from_son(c) for c in game['chat']]
+            for c in chat:
+                c.render()
+            for start in range(0, len(chat), ChatBucket.size):
+                messages = chat[start:start + ChatBucket.size]
+                bucket = ChatBucket()
+                bucket.pk = ObjectId(md5('%s:%d' % (game['_id'], start)).digest()[:12])
+                bucket.game = game['_id']
+                bucket.count = len(messages)
+                bucket.last = messages[-1].datetime
+                bucket.messages = messages
+                try:
+                    buckets.insert(bucket.to_mongo(), safe=True)
+                except DuplicateKeyError:
+                    pass
+            games.update({'_id': game['_id'], 'chat': {'$exists': True}},
+                         {'$unset': {'chat': 1}}, safe=True)
+
+            log.debug('migrated %d chat messages for game %s', len(chat), game['_id'])
+            migrated += 1
+        log.info('migrated chat for %d games', migrated)
+
+    def render_chat(self):
+        # fill in the rendered fields of chat messages added
+        # before they were stored. a bucket is only replaced
+        # if no messages were added to it in the meantime
+        buckets = ChatBucket.objects._collection
+        query = {'messages': {'$elemMatch': {'timestamp': {'$exists': False}}}}
+        rendered = 0
+        for son in buckets.find(query):
+            bucket = ChatBucket._from_son(son)
+            for c in bucket.messages:
+                if c.timestamp is None:
+                    c.render()
+            buckets.update(
+                {'_id': bucket.pk, 'count': bucket.count},
+                {'$set': {'messages': [c.to_mongo() for c in bucket.messages]}})
+            rendered += 1
+        log.info('rendered chat in %d buckets', rendered)
+
+    def migrate_votes(self, games):
+        # build Game.votes, Play.score and Game.total_votes
+        # from Play.upvotes. a game is only replaced if it
+        # hasn't changed since it was read
+        migrated = 0
+        for game in games.find({'votes': {'$exists': False}}):
+            votes = {}
+            for play in game.get('plays', []):
+                upvotes = play.pop('upvotes', [])
+                for username in upvotes:
+                    votes[vote_key(username)] = play['username']
+                play['score'] = len(upvotes)
+            games.update(
+                {'_id': game['_id'], 'version': game.get('version', {'$exists': False})},
+                {'$set': {'plays': game.get('plays', []),
+                          'votes': votes,
+                          'total_votes': len(votes)}})
+            migrated += 1
+        log.info('migrated votes for %d games', migrated)
+
+    def count_open_slots(self, games):
+        # set Game.open_slots. a playing game is only updated
+        # if no one joined it since it was read
+        games.update({'state': {'$ne': 'playing'}, 'open_slots': {'$exists': False}},
+                     {'$set': {'open_slots': 0}}, multi=True)
+        counted = 0
+        query = {'state': 'playing', 'open_slots': {'$exists': False}}
+        fields = {'num_players': 1, 'max_players': 1}
+        for game in games.find(query, fields):
+            num_players = game.get('num_players', 0)
+            open_slots = max(game.get('max_players', 10) - num_players, 0)
+            games.update(
+                dict(query, _id=game['_id'],
+                     num_players=game.get('num_players', {'$exists': False})),
+                {'$set': {'open_slots': open_slots}})
+            counted += 1
+        log.info('counted open slots for %d playing games', counted)
+
+    def assign_rand(self, games):
+        # give each game its Game.rand
+        assigned = 0
+        query = {'rand': {'$exists': False}}
+        for game in games.find(query, {'_id': 1}):
+            games.update(dict(query, _id=game['_id']),
+                         {'$set': {'rand': random.random()}})
+            assigned += 1
+        log.info('assigned rand to %d games', assigned)
+
+    def count_active(self, games):
+        # (re)set the active_games counter. games made or
+        # finished while this runs may be miscounted, so it
+        # is best run when the site is quiet
+        active = games.find({'state': {'$in': ['playing', 'voting']}}).count()
+        Counter.reset('active_games', active)
+        log.info('counted %d active games', active)
+
+    def set_voting_ends(self, games):
+        # set Game.voting_ends on playing games. a game is only
+        # updated if its round hasn't changed since it was read
+        query = {'state': 'playing', 'voting_ends': {'$exists': False}}
+        fields = {'next_ending': 1, 'minutes_per_round': 1}
+        updated = 0
+        for game in games.find(query, fields):
+            minutes = game.get('minutes_per_round', 120)
+            games.update(
+                dict(query, _id=game['_id'], next_ending=game['next_ending']),
+                {'$set': {'voting_ends': game['next_ending'] + timedelta(minutes=minutes)}})
+            updated += 1
+        log.info('set voting_ends on %d playing games', updated)
+
+    def handle_noargs(self, **options):
+        games = Game.objects._collection
+        self.migrate_chat(games)
+        self.render_chat()
+        self.migrate_votes(games)
+        self.count_open_slots(games)
+        self.assign_rand(games)
+        self.count_active(games)
+        self.set_voting_ends(games)
@@ -0,0 +1,72 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from hashlib import md5
+from logging import getLogger
+
+from bson.objectid import ObjectId
+from django.core.management.base import NoArgsCommand
+
+from game.models import Leaderboard
+
+log = getLogger('jobs.migrateleaderboard')
+
+class Command(NoArgsCommand):
+    args = ''
+    help = ('Moves scores from the old leaderboard collection, with one '
+            'document per player, to one document per player per period')
+
+    def handle_noargs(self, **options):
+        db = Leaderboard.objects._collection.database
+        old = db['leaderboard']
+
+        # scores are added to any the player already has in
+        # the new layout (from games which finished since it
+        # was deployed). each is added along with an id made
+        # from the player's username, as a game's scores are
+        # along with the game's id (see Leaderboard.add), so
+        # that if this stops partway through a player, running
+        # it again adds only the periods which are missing.
+        # the player's old document is removed once all its
+        # scores are moved, and only then are the ids removed
+        leaderboard = Leaderboard.objects._collection
+        migrated = 0
+        for doc in old.find():
+            username = doc['_id']
+            marker = ObjectId(md5('migrateleaderboard:%s' % username.encode('utf-8')).digest()[:12])
+            periods = doc.get('value', {}).keys()
+            for period in periods:
+                Leaderboard.add(period, username, int(doc['value'][period]), marker)
+            old.remove({'_id': username}, safe=True)
+            keys = ['%s:%s' % (period, username) for period in periods]
+            leaderboard.update({'_id': {'$in': keys}}, {'$pull': {'games': marker}},
+                               multi=True)
+            migrated += 1
+        log.info('migrated scores for %d players', migrated)
+        Leaderboard.invalidate_all()
+
+        if not old.count():
+            # also drops its index per period
+            old.drop()
@@ -0,0 +1,259 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from multiprocessing import Pool
+from optparse import make_option
+from pytz import utc
+import sys
+import time
+
+from django.core.management.base import NoArgsCommand
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from game.models import Game
+from game.models import Leaderboard
+from game.models import ScoreHistogram
+
+log = getLogger('jobs.rebuildleaderboard')
+
+def scores(games):
+    # sum the scores of the plays in games (dicts with
+    # next_ending and plays) by (period, username). returns
+    # the totals, and the number of games
+    totals = {}
+    read = 0
+    for game in games:
+        read += 1
+        periods = Leaderboard.periods(game['next_ending'])
+        for play in game.get('plays', []):
+            for period in periods:
+                key = (period, play['username'])
+                totals[key] = totals.get(key, 0) + play.get('score', 0)
+    return totals, read
+
+def rebuild_chunk(args):
+    # total the scores of the games which finished between
+    # start and end, and were scored no later than cutoff, in
+    # a worker process, and save them as the chunk's result.
+    # returns the number of games read
+    start, end, cutoff = args
+    games = Game.objects._collection
+    chunks = games.database['leaderboard.rebuild.chunks']
+
+    totals, read = scores(games.find(
+        {'state': 'finished', 'next_ending': {'$gte': start, '$lt': end},
+         'scored_at': {'$lte': cutoff}},
+        {'next_ending': 1, 'plays.username': 1, 'plays.score': 1}))
+
+    chunks.save({'_id': start, 'end': end,
+                 'scores': [[p, u, s] for (p, u), s in totals.iteritems()]},
+                safe=True)
+    return read
+
+class Command(NoArgsCommand):
+    args = ''
+    help = ('Recomputes the leaderboard from all finished games, in '
+            'parallel, resuming an earlier run which was interrupted')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=4,
+            help='Number of worker processes to total scores in'),
+        make_option('--days', type='int', default=7,
+            help='Days of finished games each worker totals at a time'),
+        make_option('--restart', action='store_true', default=False,
+            help='Discard the progress of an earlier, interrupted run'),
+    )
+
+    def handle_noargs(self, **options):
+        # the workers are forked before this process takes the
+        # lock and plans the chunks below, so each of them
+        # opens a connection of its own when it first totals
+        # a chunk, rather than inheriting (and interleaving
+        # replies on) the one this process is about to open
+        pool = Pool(options['workers'])
+
+        now = datetime.now(utc)
+        games = Game.objects._collection
+        db = games.database
+        bookkeeping = db['leaderboard.bookkeeping']
+        progress = db['leaderboard.rebuild']
+        chunks = db['leaderboard.rebuild.chunks']
+
+        # the same lock as the leaderboard command takes
+        try:
+            bookkeeping.find_and_modify(
+                query={'_id': 1, 'locked': False},
+                update={'$set': {'locked': True, 'started_at': now}},
+                upsert=True,
+                new=True)
+        except OperationFailure:
+            log.warning('another leaderboard job is running')
+            sys.exit(1)
+
+        try:
+            if options['restart']:
+                progress.drop()
+                chunks.drop()
+
+            # games scored up to the cutoff are counted by
+            # the rebuild; those scored after it, as it runs,
+            # are added to the rebuilt leaderboard at the end
+            run = progress.find_one({'_id': 1})
+            if run is None:
+                # finished games which were never scored, or
+                # whose scoring was interrupted, are counted by
+                # the rebuild, too
+                games.update({'state': 'finished', 'scored_at': {'$exists': False},
+                              'scoring_started': {'$not': {'$gt': now - Leaderboard.scoring_timeout}}},
+                             {'$set': {'scored_at': now}, '$unset': {'scoring_started': 1}},
+                             multi=True, safe=True)
+                first = games.find({'state': 'finished'}, {'next_ending': 1})
+                first = list(first.sort('next_ending', ASCENDING).limit(1))
+                first = first and first[0]['next_ending'] or now
+                run = {'_id': 1, 'cutoff': now, 'first': first, 'days': options['days']}
+                progress.save(run, safe=True)
+            else:
+                log.info('resuming rebuild with cutoff %s', run['cutoff'])
+            cutoff = run['cutoff']
+
+            ranges = []
+            start = run['first']
+            while start <= cutoff:
+                end = start + timedelta(days=run['days'])
+                ranges.append((start, end, cutoff))
+                start = end
+            done = set(c['_id'] for c in chunks.find({}, {'_id': 1}))
+            todo = [r for r in ranges if r[0] not in done]
+            log.info('%d of %d chunks left to total', len(todo), len(ranges))
+            read = pool.map(rebuild_chunk, todo)
+            pool.close()
+            pool.join()
+            log.info('totalled %d games', sum(read))
+
+            built = self.write(db, chunks)
+
+            # pause scoring (see Leaderboard.score) and wait for
+            # games already being scored, so that nothing is
+            # written while the new collections are put in place.
+            # the games scored after the cutoff are missing from
+            # the new leaderboard, and all of them are scored by
+            # paused_at
+            bookkeeping.update({'_id': 1}, {'$set': {'paused_at': datetime.now(utc)}}, safe=True)
+            self.wait_for_scoring(games)
+            paused_at = datetime.now(utc)
+
+            self.swap(*built)
+
+            # add the games scored while the rebuild ran
+            reapply = games.find(
+                {'state': 'finished', 'scored_at': {'$gt': cutoff, '$lte': paused_at}},
+                {'next_ending': 1, 'plays.username': 1, 'plays.score': 1})
+            totals, read = scores(reapply)
+            for (period, username), score in totals.iteritems():
+                Leaderboard.add(period, username, score)
+            log.info('added %d games scored during the rebuild', read)
+
+            # and score the games which finished while paused
+            bookkeeping.update({'_id': 1}, {'$unset': {'paused_at': 1}}, safe=True)
+            Leaderboard.score(Leaderboard.unscored())
+            Leaderboard.invalidate_all()
+
+            progress.drop()
+            chunks.drop()
+
+        except:
+            log.exception('error rebuilding leaderboard')
+
+        finally:
+            bookkeeping.find_and_modify(
+                query={'_id': 1},
+                update={'$set': {'locked': False}, '$unset': {'paused_at': 1}})
+
+    def wait_for_scoring(self, games):
+        # wait until no game is being scored, other than by a
+        # scorer which has been at it for scoring_timeout, and
+        # so is presumed dead
+        while True:
+            now = datetime.now(utc)
+            scoring = games.find({'state': 'finished', 'scored_at': {'$exists': False},
+                                  'scoring_started': {'$gt': now - Leaderboard.scoring_timeout}})
+            if not scoring.count():
+                return
+            time.sleep(1)
+
+    def write(self, db, chunks):
+        # merge the chunks' totals, and write them and their
+        # histograms to new collections. returns the arguments
+        # for swap
+        totals = {}
+        for chunk in chunks.find():
+            for period, username, score in chunk['scores']:
+                key = (period, username)
+                totals[key] = totals.get(key, 0) + score
+
+        leaderboard = Leaderboard.objects._collection
+        histograms = ScoreHistogram.objects._collection
+        new_leaderboard = db[leaderboard.name + '.rebuild']
+        new_histograms = db[histograms.name + '.rebuild']
+        new_leaderboard.drop()
+        new_histograms.drop()
+
+        batch = []
+        counts = {}
+        for (period, username), score in totals.iteritems():
+            batch.append({'_id': '%s:%s' % (period, username), 'period': period,
+                          'username': username, 'score': score})
+            if len(batch) == 1000:
+                new_leaderboard.insert(batch, safe=True)
+                batch = []
+            histogram = counts.setdefault(period, {'total': 0, 'counts': {}})
+            histogram['total'] += 1
+            for key in ScoreHistogram.keys(score):
+                histogram['counts'][key] = histogram['counts'].get(key, 0) + 1
+        if batch:
+            new_leaderboard.insert(batch, safe=True)
+        if counts:
+            new_histograms.insert([dict(h, _id=period) for period, h in counts.iteritems()],
+                                  safe=True)
+        new_leaderboard.ensure_index([('period', ASCENDING), ('score', DESCENDING),
+                                      ('username', ASCENDING)])
+
+        log.info('wrote %d scores in %d periods', len(totals), len(counts))
+        return new_leaderboard, new_histograms, len(totals)
+
+    def swap(self, new_leaderboard, new_histograms, written):
+        # put the new collections in place of the leaderboard's
+        leaderboard = Leaderboard.objects._collection
+        histograms = ScoreHistogram.objects._collection
+        # an empty collection can't be renamed
+        if written:
+            new_leaderboard.rename(leaderboard.name, dropTarget=True)
+            new_histograms.rename(histograms.name, dropTarget=True)
+        else:
+            leaderboard.remove()
+            histograms.remove()
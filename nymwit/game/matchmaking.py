@@ -0,0 +1,195 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# matchmaking seats players who asked to join any game (see
+# views.join_random) in batches, rather than having each of them
+# race the others to add_player themselves to the same few games.
+# requests are queued for settings.MATCHMAKING_WINDOW seconds, and
+# then the whole queue is seated at once: first in open games, with
+# one update per game, then in new games made for everyone left
+# over, with one insert.
+#
+# the queue belongs to the process; with more than one web process,
+# each seats its own queue, and the updates are conditional on there
+# still being room, so that they never overfill a game.
+
+__all__ = ('join', )
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from pytz import utc
+import threading
+import time
+
+from django.conf import settings
+
+from game import events
+from game import fragments
+from game.forms import make_acronym
+from game.models import Counter
+from game.models import Game
+
+log = getLogger('game.matchmaking')
+
+# games made by the matchmaker get the same settings
+# as the defaults of GameForm
+acronym_length = 6
+minutes_per_round = 120
+max_players = 10
+
+class Ticket(object):
+
+    def __init__(self, username):
+        self.username = username
+        self.game_id = None
+        self.seated = threading.Event()
+
+    def wait(self, timeout):
+        # block until the player has been seated, or timeout
+        # seconds pass. returns the id of the player's game,
+        # or None if they weren't seated
+        self.seated.wait(timeout)
+        return self.game_id
+
+class Matchmaker(object):
+
+    def __init__(self, window):
+        self.window = window
+        self.cond = threading.Condition()
+        self.queue = []
+        self.worker = None
+
+    def join(self, username):
+        ticket = Ticket(username)
+        self.cond.acquire()
+        try:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run)
+                self.worker.daemon = True
+                self.worker.start()
+            self.queue.append(ticket)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return ticket
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.queue:
+                    self.cond.wait()
+            finally:
+                self.cond.release()
+
+            # let others join the batch
+            time.sleep(self.window)
+
+            self.cond.acquire()
+            try:
+                tickets, self.queue = self.queue, []
+            finally:
+                self.cond.release()
+
+            try:
+                self.seat(tickets)
+            except Exception:
+                log.exception('error seating %d players', len(tickets))
+            for ticket in tickets:
+                ticket.seated.set()
+
+    def seat(self, tickets):
+        # a player who asked more than once (e.g. by
+        # reloading) is only seated once
+        waiting = {}
+        for ticket in tickets:
+            waiting.setdefault(ticket.username, []).append(ticket)
+
+        now = datetime.now(utc)
+        games = Game.objects._collection
+
+        # open games are read only until everyone is seated;
+        # those every waiting player is already in are left
+        # out, so that they don't use up the candidates
+        joined = []
+        for game in Game.joinable(usernames=list(waiting), limit=0):
+            usernames = [u for u in waiting if u not in game.players]
+            usernames = usernames[:game.open_slots]
+            if not usernames:
+                continue
+            n = len(usernames)
+            result = games.update(
+                {'_id': game.pk, 'state': 'playing', 'next_ending': {'$gt': now},
+                 'open_slots': {'$gte': n}, 'players': {'$nin': usernames}},
+                {'$pushAll': {'players': usernames},
+                 '$inc': {'num_players': n, 'open_slots': -n, 'version': 1}},
+                safe=True)
+            if not result['n']:
+                # someone joined the game since it was read;
+                # these players will be seated elsewhere
+                continue
+            for username in usernames:
+                for ticket in waiting.pop(username):
+                    ticket.game_id = game.pk
+            fragments.invalidate(game.players + usernames)
+            joined.append(game.pk)
+            if not waiting:
+                break
+        if joined:
+            events.publish_many(joined, 'player')
+
+        usernames = sorted(waiting)
+        created = []
+        for start in range(0, len(usernames), max_players):
+            game = Game()
+            game.acronym = make_acronym(acronym_length)
+            game.minutes_per_round = minutes_per_round
+            game.next_ending = now + timedelta(minutes=minutes_per_round)
+            game.voting_ends = game.next_ending + timedelta(minutes=minutes_per_round)
+            game.players = usernames[start:start + max_players]
+            game.num_players = len(game.players)
+            game.max_players = max_players
+            game.open_slots = max_players - game.num_players
+            created.append(game)
+        if created:
+            game_ids = games.insert([game.to_mongo() for game in created], safe=True)
+            Counter.inc('active_games', len(created))
+            for game, game_id in zip(created, game_ids):
+                for username in game.players:
+                    for ticket in waiting.pop(username):
+                        ticket.game_id = game_id
+                fragments.invalidate(game.players)
+        log.debug('seated players in %d open games and %d new games',
+                  len(joined), len(created))
+
+_matchmaker = None
+
+def join(username):
+    # queue username to be seated in a game, and return
+    # a Ticket to wait on
+    global _matchmaker
+    if _matchmaker is None:
+        _matchmaker = Matchmaker(settings.MATCHMAKING_WINDOW)
+    return _matchmaker.join(username)
@@ -23,21 +23,54 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import cgi
 import re
 from datetime import datetime, timedelta
+from logging import getLogger
 from pytz import utc
+import random
 import time
 
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
 from mongoengine import Document
 from mongoengine import EmbeddedDocument
 from mongoengine import fields
+from mongoengine.base import ValidationError
+from mongoengine.queryset import Q
 from mongoengine.queryset import queryset_manager
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from game import events
+from game import fragments
+from util import generation, next_generation
+from util import utctimestamp
+
+log = getLogger('game.models')
+
+# the cache for the leaderboard (see Leaderboard.cache_key);
+# made once, since each get_cache call makes a new client
+leaderboard_cache = get_cache(settings.LEADERBOARD_CACHE)
 
 punctuation = re.compile(r'[^a-zA-Z0-9 ]')
 
+def vote_key(username):
+    # usernames are used as keys in Game.votes, but may
+    # contain characters which can't be used in keys
+    return username.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
 class Play(EmbeddedDocument):
     username = fields.StringField()
     entry = fields.StringField()
+
+    # number of votes for this play
+    score = fields.IntField(default=0)
+
+    # usernames of players who voted for this play, in
+    # games from before Game.votes was kept; see the
+    # migrategames command
     upvotes = fields.ListField(fields.StringField())
 
 class Chat(EmbeddedDocument):
@@ -45,13 +78,100 @@ class Chat(EmbeddedDocument):
     username = fields.StringField()
     message = fields.StringField()
 
+    # the message as it is sent to clients, computed once
+    # when the message is added (see render) rather than
+    # every time it is read
+    timestamp = fields.IntField()
+    link = fields.StringField()
+    escaped = fields.StringField()
+
+    def render(self):
+        self.timestamp = utctimestamp(self.datetime)
+        self.link = reverse('account.views.profile', args=[self.username])
+        self.escaped = cgi.escape(self.message)
+
+class ChatBucket(Document):
+    # game chat is stored outside of the Game, in buckets
+    # of up to ChatBucket.size messages each, so that Game
+    # documents stay the same size no matter how much the
+    # players chat. last is the datetime of the newest
+    # message in the bucket, so that readers can skip the
+    # buckets they have already seen
+    game = fields.ObjectIdField()
+    count = fields.IntField(default=0)
+    last = fields.DateTimeField()
+    messages = fields.ListField(fields.EmbeddedDocumentField('Chat'))
+
+    meta = {
+        'indexes': [
+            {'fields': ['game', 'last']},
+        ],
+        'allow_inheritance': False,
+    }
+
+    size = 50
+
+    @classmethod
+    def add(cls, game_id, chat):
+        # append to a bucket with room in it, or start
+        # a new one if there is none
+        buckets = cls.objects(game=game_id, count__lt=cls.size)
+        buckets.update_one(push__messages=chat, inc__count=1,
+                           set__last=chat.datetime, upsert=True)
+
+    @classmethod
+    def since(cls, game_id, since=0):
+        # return a list of the game's chat messages newer
+        # than the timestamp since, oldest first
+        return cls.since_many({game_id: since}).get(game_id, [])
+
+    @classmethod
+    def since_many(cls, cursors):
+        # for a dict of game id to timestamp, return a dict of
+        # game id to the list of that game's chat messages
+        # newer than the timestamp, oldest first, in a single
+        # query. games with no new messages are omitted
+        query = None
+        for game_id, since in cursors.items():
+            q = Q(game=game_id, last__gt=datetime.fromtimestamp(since, utc))
+            query = query and query | q or q
+        if query is None:
+            return {}
+
+        game_ids = dict((str(game_id), game_id) for game_id in cursors)
+        messages = {}
+        for bucket in cls.objects(query).only('game', 'messages'):
+            game_id = game_ids[str(bucket.game)]
+            since = cursors[game_id]
+            for c in bucket.messages:
+                if c.timestamp is None:
+                    # added before messages were rendered
+                    # when they were added
+                    c.render()
+                if c.timestamp > since:
+                    messages.setdefault(game_id, []).append(c)
+        for game_messages in messages.values():
+            game_messages.sort(key=lambda c: c.datetime)
+        return messages
+
 class Game(Document):
 
     @queryset_manager
     def active(doc_cls, queryset):
         # works like Game.objects, but only
-        # shows still-active games
-        queryset.filter(state__in=('playing', 'voting'))
+        # shows still-active games, including
+        # those which are still stored as
+        # playing but are effectively voting
+        # (see effective), which needs a
+        # condition for each round length
+        from game.forms import minutes_choices
+        now = datetime.now(utc)
+        query = Q(state__in=('playing', 'voting'), next_ending__gt=now)
+        for minutes, _ in minutes_choices:
+            query = query | Q(state='playing', num_players__gte=2,
+                              minutes_per_round=minutes,
+                              next_ending__gt=now - timedelta(minutes=minutes))
+        queryset.filter(query)
         return queryset
 
     # state is 'playing', 'voting', or 'finished', or 'invalid'
@@ -67,8 +187,10 @@ class Game(Document):
     next_ending = fields.DateTimeField()
     minutes_per_round = fields.IntField(default=120)
 
-    # game chat
-    chat = fields.ListField(fields.EmbeddedDocumentField('Chat'))
+    # when the voting round will end, set when the game is
+    # made, and moved into next_ending when voting begins
+    # (so that games can be moved to voting in bulk)
+    voting_ends = fields.DateTimeField()
 
     # list of plays in this game; see class Play
     plays = fields.ListField(fields.EmbeddedDocumentField('Play'))
@@ -78,22 +200,231 @@ class Game(Document):
     num_players = fields.IntField(default=0)
     max_players = fields.IntField(default=10)
 
+    # number of players who can still join: max_players
+    # less num_players while the game is playing, and 0
+    # once it has moved on from playing
+    open_slots = fields.IntField(default=0)
+
+    # map of voter (see vote_key) to the username of the
+    # player they voted for, and the number of voters
+    votes = fields.DictField()
+    total_votes = fields.IntField(default=0)
+
+    # set while a worker (see the advancegamestate command)
+    # has claimed the game in order to advance its state
+    lease_owner = fields.StringField()
+    lease_expires = fields.DateTimeField()
+
+    # incremented whenever anything about the game which
+    # players can see changes (chat, players, plays, votes,
+    # or state); used to answer heartbeats cheaply
+    version = fields.IntField(default=0)
+
+    # a random number in [0, 1), fixed when the game is
+    # made, for picking games at random (see random_active)
+    rand = fields.FloatField(default=random.random)
+
+    # when the scores of a finished game began to be, and
+    # were all, added to the leaderboard (see Leaderboard.score)
+    scoring_started = fields.DateTimeField()
+    scored_at = fields.DateTimeField()
+
     meta = {
         'indexes': [
             {'fields': ['players', 'state']},
             {'fields': ['state', 'next_ending']},
+            {'fields': ['state', 'open_slots', 'next_ending']},
+            {'fields': ['state', 'rand']},
+            {'fields': ['id', 'version', 'state', 'next_ending',
+                        'minutes_per_round', 'num_players', 'total_votes']},
         ],
         'allow_inheritance': False,
     }
 
+    # what lists of games need to load; the plays and
+    # votes are only needed to show a single game
+    summary_fields = ('acronym', 'state', 'next_ending', 'minutes_per_round',
+                      'players', 'num_players', 'max_players', 'open_slots',
+                      'total_votes')
+
     def __unicode__(self):
         return unicode(self.pk)
 
     def save(self):
-        if self.next_ending is None:
+        created = self.next_ending is None
+        if created:
             self.next_ending = datetime.now(utc)
             self.next_ending += timedelta(minutes=self.minutes_per_round)
+            self.voting_ends = self.next_ending + timedelta(minutes=self.minutes_per_round)
+            self.open_slots = self.max_players - self.num_players
         super(Game, self).save()
+        if created:
+            Counter.inc('active_games')
+
+    @classmethod
+    def joinable(cls, usernames=(), limit=5):
+        # up to limit (or, if 0, all) playing games with room
+        # for more players, leaving out those which all of
+        # usernames are already in, soonest-ending first, found
+        # by the index on state, open_slots and next_ending.
+        # the games are read lazily, and partially loaded
+        query = {'state': 'playing', 'open_slots': {'$gt': 0},
+                 'next_ending': {'$gt': datetime.now(utc)}}
+        if usernames:
+            query['players'] = {'$not': {'$all': list(usernames)}}
+        games = cls.objects._collection.find(query, {'players': 1, 'open_slots': 1})
+        games = games.sort('next_ending', 1).limit(limit)
+        return (cls._from_son(game) for game in games)
+
+    @classmethod
+    def random_active(cls):
+        # pick an active game at random: the one with the
+        # least rand at or after a random point, found by one
+        # seek on the index on state and rand, or if there is
+        # none, wrapping around to the one with the least rand
+        # of all. this isn't uniform, since a game whose rand
+        # is after a wide gap is more likely to be picked,
+        # but is close enough to send a player to some game.
+        # returns a partially-loaded Game, or None if there
+        # are none
+        now = datetime.now(utc)
+        point = random.random()
+        for query in ({'rand__gte': point}, {}):
+            games = cls.objects(state__in=('playing', 'voting'), next_ending__gt=now, **query)
+            game = games.order_by('rand').only('rand').first()
+            if game is not None:
+                return game
+        return None
+
+    @classmethod
+    def heartbeat(cls, game_id):
+        # load only what a heartbeat needs: the game's state,
+        # timing, and players. returns a partially-loaded
+        # Game, or None if there is no such game
+        try:
+            games = cls.objects(pk=game_id)
+            games = games.only('state', 'next_ending', 'minutes_per_round',
+                               'players', 'num_players', 'total_votes',
+                               'version')
+            game = games.first()
+        except ValidationError:
+            return None
+        if game is not None:
+            game.resolve()
+        return game
+
+    @classmethod
+    def current_version(cls, game_id):
+        # read the game's version, and what is needed to know
+        # its effective state, from the index on those fields
+        # alone, without loading the document. returns a
+        # partially-loaded Game, or None if there is no such
+        # game
+        try:
+            query = cls.objects(pk=game_id)._query
+        except ValidationError:
+            return None
+        fields = ('version', 'state', 'next_ending', 'minutes_per_round',
+                  'num_players', 'total_votes')
+        cursor = cls.objects._collection.find(query, dict.fromkeys(fields, 1))
+        cursor.limit(1).hint([('_id', ASCENDING)] + [(f, ASCENDING) for f in fields])
+        for son in cursor:
+            game = cls._from_son(son)
+            if game.resolve():
+                # the version changed
+                return cls.current_version(game_id)
+            return game
+        return None
+
+    @classmethod
+    def transitioned(cls, game_ids, from_state, to_state, moved):
+        # called with the ids of games which have just been
+        # moved from one state to another. moved is the number
+        # of them which were actually moved by the caller; the
+        # rest were moved concurrently by someone else, who
+        # will also call this method for them
+        events.publish_many(game_ids, 'state')
+        players = set()
+        for game in cls.objects(pk__in=game_ids).only('players'):
+            players.update(game.players)
+        fragments.invalidate(players)
+        if from_state in ('playing', 'voting') and to_state in ('invalid', 'finished'):
+            Counter.inc('active_games', -moved)
+        if to_state == 'finished':
+            try:
+                Leaderboard.score(game_ids)
+            except Exception:
+                # the games are scored again later, by
+                # Leaderboard.score_unscored
+                log.exception('error scoring games %s', game_ids)
+
+    def advance(self, now=None):
+        # move the game on to its next state, if its current
+        # round has ended. the game is only moved if it is
+        # still in the state and round it was in when this
+        # instance was loaded, so it is safe to call this
+        # concurrently with others advancing the same game.
+        # returns the new state, or None if the game was not
+        # moved
+        now = now or datetime.now(utc)
+        if self.state not in ('playing', 'voting') or self.next_ending > now:
+            return None
+
+        update = {}
+        if self.state == 'playing':
+            update['set__open_slots'] = 0
+            if self.num_players < 2:
+                new_state = 'invalid'
+            else:
+                new_state = 'voting'
+                update['set__next_ending'] = self.next_ending + timedelta(minutes=self.minutes_per_round)
+                update['unset__voting_ends'] = 1
+        elif self.total_votes == 0:
+            new_state = 'invalid'
+        else:
+            new_state = 'finished'
+
+        games = Game.objects(pk=self.pk, state=self.state, next_ending=self.next_ending)
+        moved = games.update_one(set__state=new_state, inc__version=1, **update)
+        if not moved:
+            return None
+
+        Game.transitioned([self.pk], self.state, new_state, moved)
+        self.state = new_state
+        self.next_ending = update.get('set__next_ending', self.next_ending)
+        return new_state
+
+    def effective(self, now=None):
+        # return the game's state and next_ending as of now,
+        # as a tuple. these are ahead of what is stored if the
+        # game's round has ended and it hasn't been advanced
+        # yet; in that case they are what advance would make
+        # them
+        now = now or datetime.now(utc)
+        state, next_ending = self.state, self.next_ending
+        if state == 'playing' and next_ending <= now:
+            if self.num_players < 2:
+                return 'invalid', next_ending
+            state = 'voting'
+            next_ending += timedelta(minutes=self.minutes_per_round)
+        if state == 'voting' and next_ending <= now:
+            if self.total_votes == 0:
+                return 'invalid', next_ending
+            return 'finished', next_ending
+        return state, next_ending
+
+    def resolve(self, now=None):
+        # advance the game as far as its effective state, and
+        # set state and next_ending on this instance to match.
+        # returns True if this call changed the stored game
+        now = now or datetime.now(utc)
+        changed = False
+        while self.advance(now) is not None:
+            changed = True
+        # if someone else advanced the game first, this
+        # instance is still out of date
+        self.state, self.next_ending = self.effective(now)
+        return changed
 
     # biz logic methods. note that these DO NOT update
     # the internal state of the instance on which they
@@ -104,26 +435,41 @@ class Game(Document):
         c.username = player.username
         c.datetime = datetime.now(utc)
         c.message = message
-        self.update(push__chat=c)
+        c.render()
+        ChatBucket.add(self.pk, c)
+        self.update(inc__version=1)
+        events.publish(self.pk, 'chat')
 
     def add_player(self, player):
-        # attempt to add the given player to the Game, and
-        # return True on success, or False on failure (a
-        # race condition exists where more players than
-        # max_players can be added; if so, this attempt
-        # to add the player fails)
+        # attempt to add the given player to the Game, with
+        # a single update which only applies if the player
+        # isn't in the game, there is room for them, and the
+        # playing round hasn't ended, so that concurrent joins
+        # can never overfill the game, or join it too late.
+        # returns 'ok', 'duplicate', 'toomany', or 'closed'
         username = player.username
+        now = datetime.now(utc)
         if username in self.players:
             return 'duplicate'
-        if self.num_players >= self.max_players:
+        if self.effective(now)[0] != 'playing':
+            return 'closed'
+        if self.open_slots <= 0:
             return 'toomany'
-        self.update(push__players=username, inc__num_players=1)
-        newself = Game.objects(pk=self.pk).only('num_players').first()
-        if newself.num_players > self.max_players:
-            # race condition happened, roll back
-            self.update(pull__players=username, inc__num_players=-1)
+        games = Game.objects(pk=self.pk, players__ne=username, open_slots__gt=0,
+                             state='playing', next_ending__gt=now)
+        if games.update_one(push__players=username, inc__num_players=1,
+                            dec__open_slots=1, inc__version=1):
+            events.publish(self.pk, 'player')
+            fragments.invalidate(self.players + [username])
+            return 'ok'
+        # either the game filled up or moved on, or the player
+        # joined since this instance was loaded (e.g. by
+        # clicking "join" twice)
+        if Game.objects(pk=self.pk, players=username).count():
+            return 'duplicate'
+        if Game.objects(pk=self.pk, state='playing', next_ending__gt=now).count():
             return 'toomany'
-        return 'ok'
+        return 'closed'
 
     def entry_is_valid(self, entry):
         entry = punctuation.sub('', entry)
@@ -143,143 +489,432 @@ class Game(Document):
         # must be in the list of players, and the
         # entry must match self.acronym. return
         # True on success, otherwise False
-        if by_player.username not in self.players:
+        if by_player.username not in self.view().players:
             return False
         if not self.entry_is_valid(entry):
             return False
-        existing = self.your_play(by_player)
-        if existing:
+        games = Game.objects(pk=self.pk, state='playing',
+                             next_ending__gt=datetime.now(utc))
+        existing = self.play_index(by_player.username)
+        if existing is not None:
             # update existing play
-            key = 'set__plays__%d__entry' % existing.index
+            key = 'set__plays__%d__entry' % existing
             kwargs = {key: entry}
-            self.update(**kwargs)
+            updated = games.update_one(inc__version=1, **kwargs)
         else:
             play = Play()
             play.username = by_player.username
             play.entry = entry
-            self.update(push__plays=play)
+            updated = games.update_one(push__plays=play, inc__version=1)
+        if not updated:
+            # the playing round is over
+            return False
+        events.publish(self.pk, 'play')
         return True
 
     def record_upvote(self, by_player, for_username):
         # attempt to record an upvote by one player
-        # for another player. the two players must
-        # be different, and the voting player must
-        # not have already voted. return True if
-        # the upvote succeeded, or False otherwise
+        # for another player, replacing the voter's
+        # previous vote, if any. the two players must
+        # be different. the vote is recorded by one
+        # update, which only applies if the voter's
+        # previous vote is still what it was when this
+        # instance was loaded. return True if the upvote
+        # succeeded, or False otherwise
         if by_player.username == for_username:
             return False
 
-        # remove any other upvotes from this player
-        # (there are at most 1)
+        push = self.play_index(for_username)
+        if push is None:
+            return False
 
-        pull = None
-        push = None
-        for i, play in enumerate(self.plays):
-            if play.username == for_username:
-                push = i
-            if by_player.username in play.upvotes:
-                pull = i
+        key = 'votes.%s' % vote_key(by_player.username)
+        previous = self.votes.get(vote_key(by_player.username))
+        if previous == for_username:
+            return True
+
+        query = {'_id': self.pk, 'state': 'voting', 'next_ending': {'$gt': datetime.now(utc)}}
+        update = {'$set': {key: for_username},
+                  '$inc': {'plays.%d.score' % push: 1, 'version': 1}}
+        if previous is None:
+            # this player's first vote
+            query[key] = {'$exists': False}
+            update['$inc']['total_votes'] = 1
+        else:
+            query[key] = previous
+            update['$inc']['plays.%d.score' % self.play_index(previous)] = -1
 
-        if push == pull:
-            # either voting for the same entry, or
-            # both are None; return True or False
-            # accordingly
-            return push is not None
+        result = Game.objects._collection.update(query, update, safe=True)
+        if not result['n']:
+            # voting is over, or the voter voted again
+            # since this instance was loaded
+            return False
+        events.publish(self.pk, 'vote')
 
-        if pull is not None:
-            key = 'pull__plays__%d__upvotes' % pull
-            kwargs = {key: by_player.username}
-            self.update(**kwargs)
+        return True
 
-        key = 'push__plays__%d__upvotes' % push
-        kwargs = {key: by_player.username}
-        self.update(**kwargs)
+    def view(self):
+        # the GameView of this instance, built the first
+        # time it is needed. like the instance itself, it
+        # is not updated by the methods above
+        view = self.__dict__.get('_view')
+        if view is None:
+            view = self.__dict__['_view'] = GameView(self)
+        return view
 
-        return True
+    def play_index(self, username):
+        return self.view().play_index(username)
 
     def your_play(self, by_player):
-        for i, play in enumerate(self.plays):
-            if play.username == by_player.username:
-                play.index = i
-                return play
-        return None
+        return self.view().your_play(by_player)
 
     def your_vote(self, by_player):
-        for i, play in enumerate(self.plays):
-            if by_player.username in play.upvotes:
-                play.index = i
-                return play
-        return None
+        return self.view().your_vote(by_player)
+
+class GameView(object):
+    # a game's players, plays and votes, indexed by
+    # username, so that rendering a game (which asks
+    # about the same user many times over) doesn't
+    # scan them each time. get one with Game.view()
+
+    def __init__(self, game):
+        self.players = set(game.players)
+        self.plays = {}
+        self.play_indexes = {}
+        for i, play in enumerate(game.plays):
+            self.plays[play.username] = play
+            self.play_indexes[play.username] = i
+        self.votes = game.votes
+
+    def is_player(self, user):
+        return user.is_authenticated() and user.username in self.players
+
+    def play_index(self, username):
+        return self.play_indexes.get(username)
+
+    def your_play(self, by_player):
+        return self.plays.get(by_player.username)
+
+    def your_vote(self, by_player):
+        for_username = self.votes.get(vote_key(by_player.username))
+        return self.plays.get(for_username)
+
+class Counter(Document):
+    # counts which would be expensive to get with a query,
+    # kept up to date by $inc as what they count changes:
+    #
+    # * active_games, the number of games stored as playing
+    #   or voting (see Game.save and Game.transitioned)
+    #
+    # reads are cached in each process for ttl seconds
+
+    name = fields.StringField(db_field='_id')
+    value = fields.IntField(default=0)
+
+    meta = {
+        'allow_inheritance': False,
+        'id_field': 'name',
+    }
+
+    ttl = 5
+    __cache = {}
+
+    @classmethod
+    def inc(cls, name, by=1):
+        if by:
+            cls.objects._collection.update(
+                {'_id': name}, {'$inc': {'value': by}}, upsert=True)
+
+    @classmethod
+    def get(cls, name):
+        now = time.time()
+        value, read_at = cls.__cache.get(name, (None, None))
+        if read_at is None or now - read_at > cls.ttl:
+            counter = cls.objects._collection.find_one({'_id': name})
+            value = counter and counter.get('value', 0) or 0
+            cls.__cache[name] = (value, now)
+        return value
+
+    @classmethod
+    def reset(cls, name, value):
+        cls.objects._collection.update(
+            {'_id': name}, {'$set': {'value': value}}, upsert=True)
+        cls.__cache.pop(name, None)
 
 class Leaderboard(Document):
-    # documents in this collection are created by the
-    # map-reduce job in management/commands/leaderboard.py
+    # one document for each player's score in each period
+    # they played in. periods are "a" (all time), "yYYYY",
+    # "mYYYYMM", or "wN", where N is a weeknum (see periods).
+    # documents are updated by score, as games finish, or by
+    # the leaderboard command, for games which weren't scored
+    # as they finished
     #
-    # they should always be queried by one of the indices.
-    # there will be many, of the form "yYYYY", "mYYYY-MM",
-    # or "wYYYY-WW" where YYYY is current year or earlier,
-    # MM is a 00 - 12, and MM is 00-52 (or sometimes 53).
-    # furthermore, to make best use of the indices, always
-    # select only fields 'username', and the name of the
-    # indexed score field (this will ensure use of the
-    # covered index)
-
-    username = fields.StringField(db_field='_id')
-    scores = fields.DictField(db_field='value')
+    # there is one index, on period, score (descending) and
+    # username, which every query should use; to make best
+    # use of it, select only username and score. the id is
+    # "<period>:<username>", so that there is only ever one
+    # document per player per period. games lists the ids of
+    # the games being scored whose scores have been added
+    # to the document (see score)
+
+    key = fields.StringField(db_field='_id')
+    period = fields.StringField()
+    username = fields.StringField()
+    score = fields.IntField(default=0)
+    games = fields.ListField(fields.ObjectIdField())
 
     meta = {
+        'collection': 'leaderboard_scores',
+        'indexes': [
+            {'fields': ['period', '-score', 'username']},
+        ],
         'allow_inheritance': False,
-        'id_field': 'username',
+        'id_field': 'key',
     }
 
     @staticmethod
     def weeknum(dt):
         return (dt - datetime(1970, 1, 4, tzinfo=utc)).days / 7
 
-    __index_cache = set()
-    __index_cache_time = None
+    # exists and leaders are answered from the cache named by
+    # settings.LEADERBOARD_CACHE, which holds the set of known
+    # periods, and each period's leaders. writes delete what
+    # they change from it; jobs which rewrite the leaderboard
+    # wholesale call invalidate_all, which moves every key on
+    # to a new generation
 
     @classmethod
-    def __index_exists(cls, window, key):
-        if not cls.__index_cache_time or (time.time() - cls.__index_cache_time) > 60:
-            info = cls.objects._collection.index_information()
-            cls.__index_cache.clear()
-            cls.__index_cache.update(info.keys())
-            cls.__index_cache_time = time.time()
-        index_name = '%s.%s%s_-1__id_1' % (cls.scores.db_field, window, key)
-        return index_name in cls.__index_cache
+    def cache_key(cls, *parts):
+        current = generation(leaderboard_cache, 'leaderboard-generation',
+                             settings.LEADERBOARD_CACHE_TIMEOUT * 2)
+        return ':'.join(['leaderboard', str(current)] + [str(part) for part in parts])
+
+    @classmethod
+    def invalidate(cls, periods):
+        keys = [cls.cache_key('leaders', period) for period in periods]
+        known = leaderboard_cache.get(cls.cache_key('periods'))
+        if known is None or not known.issuperset(periods):
+            keys.append(cls.cache_key('periods'))
+        leaderboard_cache.delete_many(keys)
+
+    @classmethod
+    def invalidate_all(cls):
+        next_generation(leaderboard_cache, 'leaderboard-generation')
+
+    @classmethod
+    def periods(cls, dt):
+        # the periods which a game which finished at dt
+        # counts towards
+        return ['a', dt.strftime('y%Y'), dt.strftime('m%Y%m'), 'w%d' % cls.weeknum(dt)]
+
+    # how long a game may take to be scored before someone
+    # else may take over scoring it
+    scoring_timeout = timedelta(minutes=10)
+
+    @classmethod
+    def add(cls, period, username, score, game_id=None):
+        # add score to username's score for period, and
+        # move them in the period's ScoreHistogram. if
+        # game_id is given, the score is only added if it
+        # hasn't been already for that game
+        key = '%s:%s' % (period, username)
+        query = {'_id': key}
+        update = {'$set': {'period': period, 'username': username},
+                  '$inc': {'score': score}}
+        if game_id is not None:
+            query['games'] = {'$ne': game_id}
+            update['$addToSet'] = {'games': game_id}
+        try:
+            old = cls.objects._collection.find_and_modify(
+                query=query, update=update, fields={'score': 1}, upsert=True)
+        except OperationFailure:
+            # the upsert of a document which exists, because
+            # the game's score was already added to it
+            if game_id is None or not cls.objects._collection.find_one({'_id': key, 'games': game_id}):
+                raise
+            return
+        if not old:
+            ScoreHistogram.move(period, None, score)
+        elif score:
+            ScoreHistogram.move(period, old['score'], old['score'] + score)
+
+    @classmethod
+    def score(cls, game_ids):
+        # add the scores of the plays in the given games,
+        # if they are finished, to the leaderboard. a game
+        # is claimed by setting scoring_started, and marked
+        # scored_at once all its scores are added. each score
+        # is added along with the game's id (see add), so if
+        # scoring stops partway, whoever takes it over after
+        # scoring_timeout adds only the scores which are
+        # missing, and nothing is counted twice
+        games = Game.objects._collection
+        leaderboard = cls.objects._collection
+        for game_id in game_ids:
+            now = datetime.now(utc)
+            game = games.find_and_modify(
+                query={'_id': game_id, 'state': 'finished',
+                       'scored_at': {'$exists': False},
+                       'scoring_started': {'$not': {'$gt': now - cls.scoring_timeout}}},
+                update={'$set': {'scoring_started': now}},
+                fields={'next_ending': 1, 'plays.username': 1, 'plays.score': 1})
+            if game is None:
+                continue
+            if cls.paused():
+                # rebuildleaderboard is putting a new leaderboard
+                # in place, and will score the game when done
+                games.update({'_id': game_id, 'scoring_started': now},
+                             {'$unset': {'scoring_started': 1}})
+                continue
+
+            periods = cls.periods(game['next_ending'])
+            keys = []
+            for period in periods:
+                for play in game.get('plays', []):
+                    cls.add(period, play['username'], play.get('score', 0), game_id)
+                    keys.append('%s:%s' % (period, play['username']))
+            games.update({'_id': game_id},
+                         {'$set': {'scored_at': datetime.now(utc)},
+                          '$unset': {'scoring_started': 1}}, safe=True)
+            # the game is scored, so its id is no longer needed
+            leaderboard.update({'_id': {'$in': keys}}, {'$pull': {'games': game_id}},
+                               multi=True)
+            cls.invalidate(periods)
+
+    @classmethod
+    def bookkeeping(cls):
+        return cls.objects._collection.database['leaderboard.bookkeeping']
+
+    @classmethod
+    def paused(cls):
+        # whether scoring is paused (see rebuildleaderboard).
+        # a pause left behind by a rebuild which died ends
+        # after twice scoring_timeout
+        since = datetime.now(utc) - 2 * cls.scoring_timeout
+        return cls.bookkeeping().find_one({'_id': 1, 'paused_at': {'$gt': since}}) is not None
+
+    @classmethod
+    def unscored(cls):
+        # the ids of finished games which haven't been
+        # scored, and aren't being scored
+        now = datetime.now(utc)
+        games = Game.objects._collection.find(
+            {'state': 'finished', 'scored_at': {'$exists': False},
+             'scoring_started': {'$not': {'$gt': now - cls.scoring_timeout}}},
+            {'_id': 1})
+        return [game['_id'] for game in games]
+
+    @classmethod
+    def score_unscored(cls):
+        # score the games whose scoring failed or was
+        # interrupted; run regularly by advancegamestate and
+        # gameclock. returns the number of games scored
+        game_ids = cls.unscored()
+        if game_ids:
+            cls.score(game_ids)
+        return len(game_ids)
 
     @classmethod
     def exists(cls, window, key):
-        return cls.__index_exists(window, key)
+        cache_key = cls.cache_key('periods')
+        periods = leaderboard_cache.get(cache_key)
+        if periods is None:
+            periods = set(cls.objects._collection.distinct('period'))
+            leaderboard_cache.set(cache_key, periods, settings.LEADERBOARD_CACHE_TIMEOUT)
+        return '%s%s' % (window, key) in periods
 
     @classmethod
     def leaders(cls, window, key, n=20):
-        # generate a list of tuples of (username, score),
+        # return a list of tuples of (username, score),
         # in rank order, of top-scoring users during the
         # given time period
-        if not cls.__index_exists(window, key):
-            raise StopIteration()
+        period = '%s%s' % (window, key)
+        cache_key = cls.cache_key('leaders', period)
+        cached = leaderboard_cache.get(cache_key)
+        if cached is not None and cached[0] >= n:
+            return cached[1][:n]
 
-        indexbase = '%s%s' % (window, key)
-        index = 'scores.%s' % indexbase
-        leaders = cls.objects.order_by('-' + index).only(index, 'username')
-        for l in leaders[:n]:
-            yield (l.username, int(l.scores.get(indexbase, 0)))
+        leaders = cls.objects(period=period).order_by('-score', 'username')
+        leaders = [(l.username, l.score) for l in leaders.only('username', 'score')[:n]]
+        leaderboard_cache.set(cache_key, (n, leaders), settings.LEADERBOARD_CACHE_TIMEOUT)
+        return leaders
 
     @classmethod
     def rank(cls, window, key, username):
         # determine the rank, if any, of the user during
         # the given time period, or None if the user did
         # not play during that time
-        indexbase = '%s%s' % (window, key)
-        index = 'scores.%s' % indexbase
-        score = cls.objects(username=username)
-        score = score.only(index).first()
-        if score:
-            score = score.scores.get(indexbase)
-        if score:
-            query = {index.replace('.', '__') + '__gt': score}
-            return Leaderboard.objects(**query).order_by('-' + index).count() + 1
+        period = '%s%s' % (window, key)
+        score = cls.objects(key='%s:%s' % (period, username)).only('score').first()
+        if score and score.score:
+            return ScoreHistogram.above(period, score.score) + 1
         return None
 
+class ScoreHistogram(Document):
+    # how many players have each score in a period, kept up
+    # to date by Leaderboard.add, so that a player's rank can
+    # be had from one small read, instead of by counting the
+    # players ahead of them. the counts are kept in nested
+    # buckets: counts["L_i"] is the number of players whose
+    # score, shifted right by L bits, is i. so each score
+    # is counted in one bucket at each of the levels, and
+    # the number of players with a score below any x is the
+    # sum of at most one bucket per level (see below). total
+    # is the number of players. the keys are strings, as
+    # mongo requires
+
+    period = fields.StringField(db_field='_id')
+    total = fields.IntField(default=0)
+    counts = fields.DictField()
+
+    meta = {
+        'collection': 'leaderboard_histograms',
+        'allow_inheritance': False,
+        'id_field': 'period',
+    }
+
+    # scores must be less than 2 ** levels
+    levels = 32
+
+    @classmethod
+    def keys(cls, score):
+        # the buckets which count score
+        return ['%d_%d' % (level, score >> level) for level in range(cls.levels)]
+
+    @classmethod
+    def below_keys(cls, x):
+        # the buckets which together count every score
+        # less than x: for each bit of x which is set, the
+        # bucket at that level just before the one x is in
+        return ['%d_%d' % (level, (x >> level) - 1)
+                for level in range(cls.levels) if (x >> level) & 1]
+
+    @classmethod
+    def move(cls, period, old, new):
+        # a player's score in period changed from old (None
+        # if they had none) to new
+        inc = {}
+        if old is None:
+            inc['total'] = 1
+        for score, delta in ((old, -1), (new, 1)):
+            if score is None:
+                continue
+            for key in cls.keys(score):
+                key = 'counts.%s' % key
+                inc[key] = inc.get(key, 0) + delta
+        inc = dict((key, delta) for key, delta in inc.items() if delta)
+        if inc:
+            cls.objects._collection.update({'_id': period}, {'$inc': inc}, upsert=True)
+
+    @classmethod
+    def above(cls, period, score):
+        # the number of players with a greater score than
+        # score in period: all of them, less those with a
+        # score below score + 1
+        fields = {'total': 1}
+        for key in cls.below_keys(score + 1):
+            fields['counts.%s' % key] = 1
+        histogram = cls.objects._collection.find_one({'_id': period}, fields)
+        if histogram is None:
+            return 0
+        return histogram.get('total', 0) - sum(histogram.get('counts', {}).values())
@@ -31,6 +31,8 @@ from django.utils.timesince import timesince, timeuntil
 from django import template
 register = template.Library()
 
+from game import fragments
+
 @register.filter
 def your_play(game, user):
     play = game.your_play(user)
@@ -38,11 +40,8 @@ def your_play(game, user):
 
 @register.filter
 def can_play(game, user):
-    if game.state != 'playing':
-        return False
-    if not user.is_authenticated() or user.username not in game.players:
-        return False
-    return True
+    state, _ = game.effective()
+    return state == 'playing' and game.view().is_player(user)
 
 @register.filter
 def your_vote(game, user):
@@ -51,11 +50,8 @@ def your_vote(game, user):
 
 @register.filter
 def can_vote(game, user):
-    if game.state != 'voting':
-        return False
-    if not user.is_authenticated() or user.username not in game.players:
-        return False
-    return True
+    state, _ = game.effective()
+    return state == 'voting' and game.view().is_player(user)
 
 @register.filter
 def has_plays(game):
@@ -63,25 +59,23 @@ def has_plays(game):
 
 @register.filter
 def has_votes(game):
-    for play in game.plays:
-        if play.upvotes:
-            return True
-    return False
+    return game.total_votes > 0
 
 @register.filter
 def can_join(game, user):
     return user.is_authenticated() and \
-           game.state == 'playing' and \
-           user.username not in game.players and \
-           game.num_players < game.max_players
+           game.effective()[0] == 'playing' and \
+           user.username not in game.view().players and \
+           game.open_slots > 0
 
 @register.filter
 def can_chat(game, user):
-    return user.is_authenticated() and user.username in game.players
+    return game.view().is_player(user)
 
 @register.filter
 def chat_open(game):
-    return game.state in ('playing', 'voting') or (datetime.now(utc) - game.next_ending).seconds < 600
+    state, next_ending = game.effective()
+    return state in ('playing', 'voting') or (datetime.now(utc) - next_ending).seconds < 600
 
 @register.filter
 def filterout(sequence, thing):
@@ -89,25 +83,26 @@ def filterout(sequence, thing):
 
 @register.filter
 def gametime(game):
-    if game.state == 'finished':
-        since_str = timesince(game.next_ending)
+    state, next_ending = game.effective()
+    if state == 'finished':
+        since_str = timesince(next_ending)
         # only show the most significant part of
         # the string
         since_str, _, _ = since_str.partition(',')
         return 'Finished %s ago' % since_str.strip()
-    elif game.state == 'invalid':
-        since_str = timesince(game.next_ending)
+    elif state == 'invalid':
+        since_str = timesince(next_ending)
         # only show the most significant part of
         # the string
         since_str, _, _ = since_str.partition(',')
         return 'Cancelled %s ago' % since_str.strip()
 
-    until_str = timeuntil(game.next_ending)
+    until_str = timeuntil(next_ending)
     # add "more" just after the first set of digits, so
     # "1 hour, 15 minutes" becomes "1 more hour, 15 minutes"
     num, _, rest = until_str.partition(' ')
 
-    state = game.state[0].upper() + game.state[1:]
+    state = state[0].upper() + state[1:]
 
     return '%s for %s more %s' % (state, num, rest)
 
@@ -115,16 +110,10 @@ def gametime(game):
 def invalid_reason(game):
     if len(game.players) < 2:
         return 'Too few players'
-    elif sum(len(play.upvotes) for play in game.plays) == 0:
+    elif game.total_votes == 0:
         return 'Nobody voted'
     return ''
 
-@register.filter
-def setscore(plays):
-    for play in plays:
-        play.score = len(play.upvotes)
-    return plays
-
 
 @register.tag
 def addscript(parser, token):
@@ -147,6 +136,57 @@ class AddScriptNode(template.Node):
             context._page_scripts.append(self.script)
         return ''
 
+@register.tag
+def cachegamelist(parser, token):
+    # {% cachegamelist "name" owner games %} ... {% endcachegamelist %}
+    #
+    # renders its contents only when owner's games have changed
+    # since they were last rendered for this user (see
+    # game/fragments.py). games, which must be a plain variable,
+    # is only evaluated when the contents are rendered
+    try:
+        tag_name, name, owner, games = token.split_contents()
+    except ValueError:
+        raise template.TemplateSyntaxError("%r tag requires three arguments" % token.contents.split()[0])
+
+    if not (name[0] == name[-1] and name[0] in ('"', "'")):
+        raise template.TemplateSyntaxError("%r tag's first argument should be in quotes" % tag_name)
+    nodelist = parser.parse(('endcachegamelist', ))
+    parser.delete_first_token()
+    return CacheGameListNode(nodelist, name[1:-1], parser.compile_filter(owner), games)
+
+class CacheGameListNode(template.Node):
+    def __init__(self, nodelist, name, owner, games):
+        self.nodelist = nodelist
+        self.name = name
+        self.owner = owner
+        self.games = games
+    def render(self, context):
+        owner = self.owner.resolve(context)
+        if not owner:
+            return self.nodelist.render(context)
+        user = context.get('user')
+        viewer = user and user.username or ''
+        html = fragments.get(owner, self.name, viewer)
+        if html is not None:
+            return html
+
+        games = list(template.Variable(self.games).resolve(context) or [])
+        context.push()
+        try:
+            context[self.games] = games
+            html = self.nodelist.render(context)
+        finally:
+            context.pop()
+
+        # the list is out of date as soon as one of the
+        # games in it changes state
+        now = datetime.now(utc)
+        endings = [game.effective(now) for game in games]
+        endings = [ending for state, ending in endings if state in ('playing', 'voting')]
+        fragments.store(owner, self.name, viewer, html, endings and min(endings) or None)
+        return html
+
 @register.tag
 def scripts(parser, token):
     return RenderScriptsNode()
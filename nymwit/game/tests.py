@@ -30,8 +30,13 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import threading
+
 from django.test import TestCase
 
+from game.models import Counter
+from game.models import Game
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -39,3 +44,51 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class Player(object):
+    def __init__(self, username):
+        self.username = username
+
+
+class JoinTest(TestCase):
+    def setUp(self):
+        self.game = Game(acronym='TEST', max_players=5)
+        self.game.save()
+
+    def tearDown(self):
+        # saving the game counted it as active
+        self.game.delete()
+        Counter.inc('active_games', -1)
+
+    def test_concurrent_joins(self):
+        """
+        Tests that concurrent joins never overfill a game.
+        """
+        results = []
+        def join(username):
+            game = Game.objects(pk=self.game.pk).first()
+            results.append(game.add_player(Player(username)))
+
+        threads = [threading.Thread(target=join, args=('player%d' % i,))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        game = Game.objects(pk=self.game.pk).first()
+        self.assertEqual(results.count('ok'), 5)
+        self.assertEqual(results.count('toomany'), 15)
+        self.assertEqual(game.num_players, 5)
+        self.assertEqual(len(game.players), 5)
+
+    def test_duplicate_join(self):
+        """
+        Tests that joining twice reports a duplicate.
+        """
+        self.assertEqual(self.game.add_player(Player('player')), 'ok')
+        self.assertEqual(self.game.add_player(Player('player')), 'duplicate')
+        self.game.reload()
+        self.assertEqual(self.game.add_player(Player('player')), 'duplicate')
+        self.assertEqual(self.game.num_players, 1)
@@ -31,6 +31,7 @@ urlpatterns = patterns('game.views',
     url(r'^game/$', 'random_game'),
     url(r'^game/join/$', 'join_random'),
     url(r'^game/new/$', 'new_game'),
+    url(r'^game/heartbeat/$', 'heartbeats'),
 
     url(r'^game/(?P<game_id>[0-9a-f]+)/$', 'game'),
     url(r'^game/(?P<game_id>[0-9a-f]+)/join/$', 'join'),
@@ -23,22 +23,24 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import cgi
 from datetime import datetime, timedelta
+from hashlib import md5
 import json
 from pytz import utc
-import random
 import re
 import time
 
-from django.core.urlresolvers import reverse
+from django.conf import settings
 from django.contrib.messages import add_message, SUCCESS, ERROR
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
 from django.http import Http404
 from mongoengine.django.shortcuts import get_document_or_404
 
-from game.models import Game, Leaderboard
+from game import events
+from game import matchmaking
+from game.models import ChatBucket, Counter, Game, Leaderboard
 from game.forms import *
 from game.templatetags.game import gametime
 from util import *
@@ -46,12 +48,14 @@ from util import *
 
 def index(request):
     your_games = []
+    other_games = Counter.get('active_games')
     if request.user and request.user.is_authenticated():
         your_games = Game.active(players=request.user.username)
-        other_games = Game.active.filter(players__nin=[request.user.username])
-        other_games = other_games.count()
-    else:
-        other_games = Game.active.count()
+        your_games = your_games.only(*Game.summary_fields)
+        # counted like active_games is, by stored state
+        yours = Game.objects(players=request.user.username,
+                             state__in=('playing', 'voting'))
+        other_games = max(other_games - yours.count(), 0)
 
     return render(request, 'index.html',
         your_games=your_games,
@@ -78,6 +82,7 @@ def new_game(request):
 
 def game(request, game_id):
     game = get_document_or_404(Game, pk=game_id)
+    game.resolve()
 
     play_form = None
     vote_form = None
@@ -101,7 +106,7 @@ def game(request, game_id):
                    if play.username != request.user.username]
         vote = game.your_vote(request.user)
         if vote:
-            initial['entry'] = vote.index
+            initial['entry'] = game.play_index(vote.username)
         vote_form = VoteForm(entries=entries, game=game, initial=initial)
         if request.method == 'POST':
             vote_form = VoteForm(request.POST, entries=entries, game=game)
@@ -118,19 +123,17 @@ def game(request, game_id):
                   play_form=play_form,
                   vote_form=vote_form,
                   chat_form=chat_form,
-                  chatlog_json=json.dumps(_chatlog_json(game)))
+                  chatlog_json=json.dumps(_chatlog_json(ChatBucket.since(game.pk))))
 
-def _chatlog_json(game, since_timestamp=0):
+def _chatlog_json(chats):
     messages = []
-    for chat in game.chat:
-        timestamp = utctimestamp(chat.datetime)
-        if timestamp > since_timestamp:
-            messages.append({
-                't': timestamp,
-                'u': chat.username,
-                'l': reverse('account.views.profile', args=[chat.username]),
-                'm': cgi.escape(chat.message),
-            })
+    for chat in chats:
+        messages.append({
+            't': chat.timestamp,
+            'u': chat.username,
+            'l': chat.link,
+            'm': chat.escaped,
+        })
     return messages
 
 @login_required
@@ -148,16 +151,10 @@ def chat(request, game_id):
 def join(request, game_id):
     game = get_document_or_404(Game, pk=game_id)
 
-    random_join = request.session.pop('join_auto', None)
-
     status = game.add_player(request.user)
     if status in ('ok', 'duplicate'):
         add_message(request, SUCCESS, "Great, you're in.")
     elif status == 'toomany':
-        if random_join and random_join == game.pk:
-            # we tried to join a game which became
-            # full by the time we tried to join it
-            return redirect('game.views.join_random')
         add_message(request, ERROR, "Sorry, this game is full :-(")
     else:
         add_message(request, ERROR, "Sorry, you can't join this game :-(")
@@ -166,28 +163,71 @@ def join(request, game_id):
 
 @login_required
 def join_random(request):
-    games = Game.objects(players__ne=request.user.username, state='playing')
-    games.where('this[~num_players] < this[~max_players]')
-    games.order_by('next_ending').limit(1)
-    for game in games:
-        request.session['join_auto'] = game.pk
-        return redirect('game.views.join', game.pk)
-    else:
+    # wait to be seated along with everyone else who asked
+    # at about the same time (see game/matchmaking.py)
+    ticket = matchmaking.join(request.user.username)
+    game_id = ticket.wait(settings.MATCHMAKING_TIMEOUT)
+    if game_id is None:
         return render(request, 'nogames.html')
+    add_message(request, SUCCESS, "Great, you're in.")
+    return redirect('game.views.game', game_id)
 
 def random_game(request):
-    n = min(Game.active.count(), 100)
-    if n == 0:
+    game = Game.random_active()
+    if game is None:
         return render(request, 'nogames.html')
-
-    game = Game.active.skip(random.randint(0, n - 1)).limit(1).only('pk').first()
     return redirect('game.views.game', game.pk)
 
+def _etag(game, user):
+    # identifies a heartbeat response: it changes whenever
+    # the game does (see Game.version) or when its status
+    # text does, and differs per user, since the players
+    # are listed relative to the user who is asking
+    tag = '%d:%s:%s' % (game.version, gametime(game), user.username)
+    return '"%s"' % md5(tag.encode('utf-8')).hexdigest()
+
+def _wait_for_change(game_id, user, etag):
+    # block until the game's ETag differs from the one the
+    # client already has, or the long-poll timeout expires,
+    # and return the latest partially-loaded game, or None if
+    # there is no such game. the game is re-read when an event
+    # is published for it, and every HEARTBEAT_INTERVAL
+    # seconds in case of changes which no event announces
+    # (e.g. the status text, which changes over time).
+    # waiting yields to other requests when running on a
+    # cooperative (e.g. gevent) worker
+    subscription = events.subscribe(game_id)
+    try:
+        deadline = time.time() + settings.HEARTBEAT_TIMEOUT
+        current = Game.current_version(game_id)
+        while current is not None and _etag(current, user) == etag:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            subscription.wait(min(remaining, settings.HEARTBEAT_INTERVAL))
+            current = Game.current_version(game_id)
+        return current
+    finally:
+        subscription.close()
+
 def heartbeat(request, game_id):
-    game = get_document_or_404(Game, pk=game_id)
     if request.method == 'GET' and 'application/json' in request.META['HTTP_ACCEPT']:
+        etag = request.META.get('HTTP_IF_NONE_MATCH')
+        if etag and 'wait' in request.GET:
+            current = _wait_for_change(game_id, request.user, etag)
+        else:
+            current = Game.current_version(game_id)
+        if current is None:
+            raise Http404()
+
+        if etag == _etag(current, request.user):
+            return HttpResponseNotModified()
+
+        game = Game.heartbeat(game_id)
+        if game is None:
+            raise Http404()
         since_timestamp = int(request.GET.get('since', 0))
-        chatlog = _chatlog_json(game, since_timestamp)
+        chatlog = _chatlog_json(ChatBucket.since(game.pk, since_timestamp))
         out = {
             'state': game.state,
             'nice_state': gametime(game),
@@ -195,9 +235,44 @@ def heartbeat(request, game_id):
             'chat': chatlog,
             'players': filter(lambda x: x != request.user.username, game.players),
         }
+        response = HttpResponse(json.dumps(out), mimetype='application/json')
+        response['ETag'] = _etag(game, request.user)
+        return response
+
+    return redirect('game.views.game', game_id)
+
+def heartbeats(request):
+    # heartbeat for several games at once, for pages which
+    # list games. the games parameter is a comma-separated
+    # list of game_id:since pairs, where since is the newest
+    # chat timestamp the client has for that game
+    if request.method == 'GET' and 'application/json' in request.META['HTTP_ACCEPT']:
+        cursors = {}
+        pairs = request.GET.get('games', '').split(',')
+        for pair in pairs[:settings.HEARTBEAT_MAX_GAMES]:
+            game_id, _, since = pair.partition(':')
+            if re.match(r'^[0-9a-f]{24}$', game_id):
+                cursors[game_id] = since.isdigit() and int(since) or 0
+
+        games = Game.objects(pk__in=cursors.keys())
+        games = games.only('state', 'next_ending', 'minutes_per_round',
+                           'num_players', 'total_votes')
+        chats = ChatBucket.since_many(cursors)
+
+        out = {}
+        for game in games:
+            game.resolve()
+            game_id = str(game.pk)
+            out[game_id] = {
+                'state': game.state,
+                'nice_state': gametime(game),
+                'next_ending': utctimestamp(game.next_ending),
+                'num_players': game.num_players,
+                'chat': _chatlog_json(chats.get(game_id, [])),
+            }
         return HttpResponse(json.dumps(out), mimetype='application/json')
 
-    return redirect('game.views.game', game.pk)
+    return redirect('game.views.index')
 
 def time_period(window, key):
     if key == None:
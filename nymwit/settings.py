@@ -96,6 +96,61 @@ SESSION_ENGINE = 'mongoengine.django.sessions'
 
 APPEND_SLASH = True
 
+# heartbeat requests made with "wait" are held open for up
+# to HEARTBEAT_TIMEOUT seconds until the game changes. they
+# wake up on game events (see game/events.py), and re-check
+# the game every HEARTBEAT_INTERVAL seconds regardless. these
+# should be served by a cooperative worker, e.g. gunicorn -k
+# gevent. with more than one web process, or to hear about
+# state changes made by the advancegamestate command, use
+# game.events.MongoEventBus
+HEARTBEAT_TIMEOUT = 25
+HEARTBEAT_INTERVAL = 10
+GAME_EVENTS_BACKEND = 'game.events.LocalEventBus'
+
+# the most games the batched heartbeat will report on
+HEARTBEAT_MAX_GAMES = 50
+
+# requests to join any game are queued for MATCHMAKING_WINDOW
+# seconds, then seated together (see game/matchmaking.py); a
+# request gives up after MATCHMAKING_TIMEOUT seconds
+MATCHMAKING_WINDOW = 0.5
+MATCHMAKING_TIMEOUT = 10
+
+# rendered lists of users' games are cached (see
+# game/fragments.py) for up to GAMELIST_CACHE_TIMEOUT seconds.
+# the local memory cache is per process; with more than one
+# web process, use a cache they share, e.g. FileBasedCache
+# with a LOCATION directory, or MemcachedCache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'leaderboard': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'leaderboard',
+    },
+}
+GAMELIST_CACHE_TIMEOUT = 300
+GAMELIST_GENERATION_TIMEOUT = 86400
+
+# leaderboard pages are answered from the LEADERBOARD_CACHE
+# cache, which is cleared of what changes as games finish and
+# by the leaderboard jobs. those mostly run in other processes
+# than the web server, so in production use a cache they
+# share, e.g. FileBasedCache with a LOCATION directory;
+# otherwise pages are up to LEADERBOARD_CACHE_TIMEOUT seconds
+# out of date
+LEADERBOARD_CACHE = 'leaderboard'
+LEADERBOARD_CACHE_TIMEOUT = 300
+
+# tests run against their own database, which is dropped
+# afterwards (see testrunner.py). TEST_MONGO_CONNECTION has
+# the other arguments to mongoengine.connect, e.g. host
+TEST_RUNNER = 'testrunner.TestRunner'
+TEST_MONGO_DATABASE = 'nymwit_test'
+TEST_MONGO_CONNECTION = {}
+
 try:
     from local_settings import *
 except:
@@ -1,15 +1,18 @@
 (function() {
   var latest = 0;
   var timeout = null;
+  var etag = null;
+  var pending = null;
+  var failures = 0;
 
   function next_timeout() {
-    var diff = (Date.now() / 1000) - latest;
-    if (diff < 5) {
-      return 1000;
-    } else if (diff < 10) {
+    // heartbeats are long-polls which return as soon as
+    // something changes, so poll again right away unless
+    // the server is having trouble, then back off
+    if (failures == 0) {
+      return 100;
+    } else if (failures < 3) {
       return 5000;
-    } else if (diff < 20) {
-      return 10000;
     } else {
       return 20000;
     }
@@ -63,7 +66,20 @@
   function do_heartbeat() {
     var path = window.location.pathname;
     var url = (/\/$/.test(path) ? path : path + '/') + 'heartbeat/';
-    jQuery.getJSON(url, {since: latest}, function(heartbeat) {
+    var data = {since: latest};
+    var headers = {};
+    if (etag !== null) {
+      data.wait = 1;
+      headers['If-None-Match'] = etag;
+    }
+    pending = jQuery.ajax({url: url, data: data, headers: headers, dataType: 'json', success: function(heartbeat, status, xhr) {
+      pending = null;
+      failures = 0;
+      if (status === 'notmodified') {
+        timeout = setTimeout(do_heartbeat, next_timeout());
+        return;
+      }
+      etag = xhr.getResponseHeader('ETag');
       var chat = heartbeat.chat;
       chat.sort(by_timestamp);
       for (var i=0; i<chat.length; i++) {
@@ -90,7 +106,14 @@
         gamestate = heartbeat.state;
       }
       timeout = setTimeout(do_heartbeat, next_timeout());
-    });
+    }, error: function(xhr, status) {
+      pending = null;
+      if (status === 'abort') {
+        return;
+      }
+      failures++;
+      timeout = setTimeout(do_heartbeat, next_timeout());
+    }});
   }
 
   function prepend(c) {
@@ -114,6 +137,10 @@
       var form = this;
       clearTimeout(timeout);
       timeout = null;
+      if (pending !== null) {
+        pending.abort();
+        pending = null;
+      }
       var url = $(form).attr('action');
       var data = {
         message: $(form).find('#id_message').val(),
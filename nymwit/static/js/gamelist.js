@@ -0,0 +1,54 @@
+(function() {
+  var cursors = {};
+  var url = null;
+
+  function do_heartbeat() {
+    var games = [];
+    for (var game_id in cursors) {
+      games.push(game_id + ':' + cursors[game_id]);
+    }
+    if (games.length == 0) {
+      return;
+    }
+    jQuery.ajax({url: url, data: {games: games.join(',')}, dataType: 'json', success: function(heartbeats) {
+      for (var game_id in heartbeats) {
+        var heartbeat = heartbeats[game_id];
+        var li = $('#game-' + game_id);
+        li.find('span.gametime').empty().append(heartbeat.nice_state);
+        var chat = heartbeat.chat;
+        for (var i=0; i<chat.length; i++) {
+          cursors[game_id] = Math.max(cursors[game_id], chat[i].t);
+        }
+        if (chat.length > 0) {
+          var unread = li.find('span.unread');
+          if (unread.length == 0) {
+            unread = $('<span class="unread"></span>').appendTo(li);
+            unread.data('count', 0);
+          }
+          unread.data('count', unread.data('count') + chat.length);
+          var count = unread.data('count');
+          unread.empty().text('(' + count + ' new message' + (count == 1 ? '' : 's') + ')');
+        }
+      }
+      setTimeout(do_heartbeat, 20000);
+    }, error: function() {
+      setTimeout(do_heartbeat, 20000);
+    }});
+  }
+
+  $(document).ready(function() {
+    // finished games' lists have no heartbeat url, since
+    // those games can't change
+    var lists = $('ul.gamelist[data-heartbeats]');
+    if (lists.length == 0) {
+      return;
+    }
+    url = lists.attr('data-heartbeats');
+    var now = Math.floor(Date.now() / 1000);
+    lists.find('li').each(function() {
+      cursors[this.id.replace(/^game-/, '')] = now;
+    });
+    setTimeout(do_heartbeat, 20000);
+  });
+
+})();
@@ -0,0 +1,47 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# runs "manage.py test" against its own mongo database,
+# TEST_MONGO_DATABASE, rather than the one the site uses,
+# and drops it when the tests are done. nymwit has no sql
+# databases for django's runner to set up
+
+__all__ = ('TestRunner', )
+
+from django.conf import settings
+from django.test.simple import DjangoTestSuiteRunner
+from mongoengine import connect
+
+class TestRunner(DjangoTestSuiteRunner):
+
+    def setup_databases(self, **kwargs):
+        # before anything has used the site's connection
+        connect(settings.TEST_MONGO_DATABASE, tz_aware=True,
+                **settings.TEST_MONGO_CONNECTION)
+
+    def teardown_databases(self, old_config, **kwargs):
+        from game.models import Game
+        db = Game.objects._collection.database
+        db.connection.drop_database(db.name)
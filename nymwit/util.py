@@ -23,7 +23,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-__all__ = ('render', 'redirect', 'utctimestamp')
+__all__ = ('render', 'redirect', 'utctimestamp', 'generation', 'next_generation')
 
 import time
 import pytz
@@ -45,3 +45,24 @@ def utctimestamp(thedatetime):
     local_datetime = thedatetime.astimezone(server_timezone)
     return int(time.mktime(local_datetime.timetuple()))
 
+# a generation number in a cache is part of the keys of what
+# is cached under it, so moving it on to the next generation
+# (with next_generation) invalidates them all at once
+
+def generation(cache, key, timeout):
+    value = cache.get(key)
+    if value is None:
+        # start from the time, rather than 0, so that if the
+        # generation is evicted, the keys of the ones before
+        # it still aren't used
+        value = int(time.time() * 1000)
+        if not cache.add(key, value, timeout):
+            value = cache.get(key, value)
+    return value
+
+def next_generation(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # no generation yet, so nothing to invalidate
+        pass